@@ -0,0 +1,82 @@
+#
+# -*- coding: utf-8 -*-
+#
+import os
+import os.path
+import sys
+import logging
+import argparse
+
+from predict.decisiontree.forest import load_trees
+from predict.decisiontree.forest import write_trees
+from predict.decisiontree import share_subtrees
+
+def config_logging(level):
+    # create logger
+    logger = logging.getLogger('training')
+    level_mapping = {
+        'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warn': logging.WARNING,
+    }
+    # root logger
+    logger.setLevel(level_mapping[level])
+    logging.getLogger().setLevel(level_mapping[level])
+
+    # create console handler and set level to debug
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+
+    # add ch to logger
+    logger.addHandler(ch)
+
+def main(args):
+    config_logging(args.log_level)
+    if os.path.isdir(args.forest):
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+            
+        for f in sorted(os.listdir(args.forest)):
+            if os.path.isfile(os.path.join(args.forest, f)):
+                convert(os.path.join(args.forest, f), os.path.join(args.output, f), args.share_subtrees)
+                
+    else:
+        convert(args.forest, args.output, args.share_subtrees)
+        
+def convert(input_path, output_path, shared=False):
+    trees = load_trees(input_path)
+    if shared:
+        trees = share_subtrees(trees)
+        
+    with open(output_path, 'wb') as output_file:
+        write_trees(trees, output_file)
+        
+    logging.info('converted %d trees from "%s" into "%s"' % (len(trees), input_path, output_path))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Converts a Random Forest into the binary forest format',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('forest',
+        type=str,
+        help='forest data obtained from training phase: can be a directory or a file')
+
+    parser.add_argument('output',
+        type=str,
+        help='resulting forest file, or directory when converting a directory')
+
+    parser.add_argument('-d', '--share-subtrees',
+        action='store_true',
+        help='stores identical subtrees once across the trees of each file')
+
+    parser.add_argument('-l', '--log-level',
+        type=str,
+        default='info',
+        choices=['debug', 'info', 'warn'],
+        help='sets the level for logging messsages')
+
+    args = parser.parse_args()
+    main(args)
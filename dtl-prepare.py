@@ -1,62 +1,265 @@
+#
+# -*- coding: utf-8 -*-
+#
+import os.path
+import sys
+import csv
+import struct
 import random
+import hashlib
 import logging
 import argparse
-import csv
+from fractions import gcd
 
-def file_len(f):
-    for i, l in enumerate(f):
-        pass
+# size in bytes of the write buffer of each output file
+WRITE_BUFFER_SIZE = 1 << 20
 
-    f.seek(0)
-    return i + 1
+# row ids are hashed onto [0, 1) from 64 bits of their digest
+HASH_SCALE = float(1 << 64)
 
-def main(args):
-    # splits the input file in various buckets for testing quality of training
-    input_file = open(args.csv_input_file, 'rb')
-    
-    input_file_size = file_len(input_file)
-
-    leftover_size = int(float(args.leftover_ratio_pct) * input_file_size / 100.0)
-    leftovers = random.sample(xrange(input_file_size), leftover_size)
-
-    # splitting input rows
-    output_file = open(args.output, 'w')
-    check_file = open(args.check, 'w')
-    training_file = open(args.training, 'w')
-
-    input_rows = csv.reader(input_file)
-    first_line = next(input_rows)
-    headers = first_line[1:]
-    expected_row_size = len(first_line)
-    index_target = headers.index(args.target_column)
-    id_column = first_line[0]
-    training_file.write(','.join(first_line) + '\n')
-    output_file.write(','.join([id_column] + [column for column in headers if column != args.target_column]) + '\n')
-    check_file.write(','.join([first_line[0], args.target_column]) + '\n')
-    for index, row in enumerate(input_rows):
-    	if len(row) not in (0, expected_row_size):
-    		logging.warning('ignoring row with unexpected size: %d (expected %d)' % (len(row), expected_row_size))
-    		continue
-    		
-        if index in leftovers:
-            # this becomes a test sample
-            columns = row[1:]
-            values = [column for count, column in enumerate(columns)
-                if count != index_target]
-
-            output_file.write(','.join([row[0]] + values) + '\n')
-
-            # cross-checks
-            check_file.write(','.join([row[0], columns[index_target]]) + '\n')
+# default bound on the number of strata, and so on the memory of a stratified split
+MAX_STRATA = 10000
+
+def config_logging(level):
+    # create logger
+    logger = logging.getLogger('training')
+    level_mapping = {
+        'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warn': logging.WARNING,
+    }
+    # root logger
+    logger.setLevel(level_mapping[level])
+    logging.getLogger().setLevel(level_mapping[level])
+
+    # create console handler and set level to debug
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+
+    # add ch to logger
+    logger.addHandler(ch)
+
+def fold_path(path, fold, folds_count):
+    """Output file of a fold, numbered from 1 before the extension when there are several folds."""
+    if folds_count == 1:
+        return path
+
+    root, extension = os.path.splitext(path)
+    return '%s-%d%s' % (root, fold + 1, extension)
+
+def split_slots(leftover_ratio_pct, folds_count):
+    """
+    Smallest block of assignments having the expected proportions, a slot
+    being the fold a row is a test sample of, None for training only.
+
+    @param leftover_ratio_pct: size of the test set in percent, for a single fold
+    @param folds_count: number of folds, each row being a test sample of exactly one fold when above 1
+    """
+    if folds_count > 1:
+        return range(folds_count)
+
+    divisor = gcd(leftover_ratio_pct, 100)
+    test_slots = leftover_ratio_pct // divisor
+    return [0] * test_slots + [None] * (100 // divisor - test_slots)
+
+def row_position(row_id, salt):
+    """
+    Maps a row id onto [0, 1), the same id always giving the same position
+    for a given salt, whatever the order of the rows.
+    """
+    digest = hashlib.md5('%s:%s' % (salt, row_id)).digest()
+    return struct.unpack('<Q', digest[:8])[0] / HASH_SCALE
+
+class HashAssigner(object):
+
+    """
+        Bernoulli assignment of the rows from a hash of their id: proportions
+        are met on average, and rows sharing an id always fall together.
+    """
+
+    def __init__(self, slots, salt):
+        self.slots = slots
+        self.salt = salt
+
+    def assign(self, row, target):
+        return self.slots[int(row_position(row[0], self.salt) * len(self.slots))]
+
+class StratifiedAssigner(object):
+
+    """
+        Assigns the rows of each stratum of the target from shuffled blocks of
+        slots, so that each stratum is split in the expected proportions, up
+        to a single block. A pending block is kept per stratum, so continuous
+        targets must be grouped by intervals.
+    """
+
+    def __init__(self, slots, seed, strata_width=None, max_strata=MAX_STRATA):
+        """
+        @param slots: block of assignments, see split_slots
+        @param strata_width: width of the intervals numeric targets are grouped by, None for grouping equal values
+        @param max_strata: number of strata above which the split fails
+        """
+        self.slots = slots
+        self.strata_width = strata_width
+        self.max_strata = max_strata
+        self._random = random.Random(seed)
+        self._pending = dict()
+
+    def stratum(self, target):
+        if self.strata_width is None:
+            return target
+
+        try:
+            return int(float(target) // self.strata_width)
+
+        except ValueError:
+            return target
+
+    def assign(self, row, target):
+        stratum = self.stratum(target)
+        pending = self._pending.get(stratum)
+        if pending is None and len(self._pending) == self.max_strata:
+            raise ValueError('more than %d target strata, continuous targets must be grouped with --strata-width'
+                % self.max_strata)
+
+        if not pending:
+            pending = list(self.slots)
+            self._random.shuffle(pending)
+            self._pending[stratum] = pending
+
+        return pending.pop()
+
+class FoldWriters(object):
+
+    """
+        Buffered output files of all the folds, each row being written as a
+        test sample of its fold and as a training sample of the other folds.
+    """
+
+    def __init__(self, args, first_line, index_target, folds_count):
+        """
+        @param first_line: header of the input file
+        @param index_target: position of the target column, not counting the id column
+        """
+        headers = first_line[1:]
+        self.index_target = index_target
+        # positions of the id and of the input columns within a row
+        self.test_positions = [0] + [position + 1 for position in xrange(len(headers)) if position != index_target]
+        self.files = list()
+        self.folds = list()
+        for fold in xrange(folds_count):
+            writers = [self._writer(fold_path(path, fold, folds_count))
+                for path in (args.output, args.check, args.training)]
+            self.folds.append(writers)
+
+        test_header = [first_line[p] for p in self.test_positions]
+        for test_writer, check_writer, training_writer in self.folds:
+            test_writer.writerow(test_header)
+            check_writer.writerow([first_line[0], headers[index_target]])
+            training_writer.writerow(first_line)
+
+        self.counts = [0] * folds_count
+
+    def _writer(self, path):
+        output_file = open(path, 'wb', WRITE_BUFFER_SIZE)
+        self.files.append(output_file)
+        return csv.writer(output_file, lineterminator='\n')
+
+    def write(self, row, fold):
+        """
+        @param fold: fold the row is a test sample of, None for a training sample of every fold
+        """
+        for position, (test_writer, check_writer, training_writer) in enumerate(self.folds):
+            if position == fold:
+                test_writer.writerow([row[p] for p in self.test_positions])
+                # cross-checks
+                check_writer.writerow([row[0], row[self.index_target + 1]])
+                self.counts[position] += 1
+
+            else:
+                training_writer.writerow(row)
+
+    def close(self):
+        for output_file in self.files:
+            output_file.close()
+
+def valid_rows(input_rows, expected_row_size):
+    """Skips the empty rows and those whose size does not match the header."""
+    for row in input_rows:
+        if len(row) != expected_row_size:
+            if row:
+                logging.warning('ignoring row with unexpected size: %d (expected %d)' % (len(row), expected_row_size))
+
+            continue
+
+        yield row
+
+def write_reservoir(rows, writers, test_size, seed):
+    """
+    Picks exactly test_size test samples by reservoir sampling, the other
+    rows being written as training samples as soon as they are discarded.
+    Test samples are written in the order of the input.
+    """
+    sampler = random.Random(seed)
+    reservoir = list()
+    for index, row in enumerate(rows):
+        if index < test_size:
+            reservoir.append((index, row))
+            continue
+
+        position = sampler.randint(0, index)
+        if position < test_size:
+            evicted = reservoir[position][1]
+            reservoir[position] = (index, row)
+            writers.write(evicted, None)
 
         else:
-            # this becomes a training sample
-            training_file.write(','.join(row) + '\n')
+            writers.write(row, None)
+
+    if len(reservoir) < test_size:
+        logging.warning('only %d rows available for %d test samples' % (len(reservoir), test_size))
+
+    for index, row in sorted(reservoir):
+        writers.write(row, 0)
+
+def main(args):
+    # splits the input file in various buckets for testing quality of training, in a single pass
+    config_logging(args.log_level)
+    seed = args.seed
+    if seed is None:
+        seed = random.randint(0, 1 << 30)
+        logging.info('using seed %d' % seed)
+
+    with open(args.csv_input_file, 'rb') as input_file:
+        input_rows = csv.reader(input_file)
+        first_line = next(input_rows)
+        headers = first_line[1:]
+        index_target = headers.index(args.target_column)
+        folds_count = max(args.folds, 1)
+        writers = FoldWriters(args, first_line, index_target, folds_count)
+        try:
+            rows = valid_rows(input_rows, len(first_line))
+            if args.test_size is not None:
+                write_reservoir(rows, writers, args.test_size, seed)
+
+            else:
+                slots = split_slots(args.leftover_ratio_pct, folds_count)
+                if args.stratify:
+                    assigner = StratifiedAssigner(slots, seed, args.strata_width, args.max_strata)
+
+                else:
+                    assigner = HashAssigner(slots, seed)
+
+                for row in rows:
+                    writers.write(row, assigner.assign(row, row[index_target + 1]))
+
+        finally:
+            writers.close()
 
-    input_file.close()
-    output_file.close()
-    check_file.close()
-    training_file.close()
+    for fold, count in enumerate(writers.counts):
+        logging.info('fold %d: %d test samples' % (fold + 1, count))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generates test data for Random Forests using existing samples',
@@ -65,7 +268,7 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output',
         type=str,
         default='tests.csv',
-        help='test samples')
+        help='test samples, numbered by fold when there are several folds')
 
     parser.add_argument('-c', '--check',
         type=str,
@@ -91,6 +294,57 @@ if __name__ == '__main__':
         default='target',
         help='name of the ouput column')
 
+    parser.add_argument('-k', '--folds',
+        type=int,
+        default=1,
+        help='number of folds for cross-validation, each row being a test sample of one fold and a training sample of the others')
+
+    parser.add_argument('-g', '--stratify',
+        action='store_true',
+        help='splits each value of the target in the expected proportions, rather than hashing the row ids')
+
+    parser.add_argument('-w', '--strata-width',
+        type=float,
+        default=None,
+        help='groups numeric targets by intervals of this width when stratifying')
+
+    parser.add_argument('-m', '--max-strata',
+        type=int,
+        default=MAX_STRATA,
+        help='maximum number of strata when stratifying, bounding memory use')
+
+    parser.add_argument('-n', '--test-size',
+        type=int,
+        default=None,
+        help='exact number of test samples, picked by reservoir sampling')
+
+    parser.add_argument('-s', '--seed',
+        type=int,
+        default=None,
+        help='seed of the split, a random one being used by default')
+
+    parser.add_argument('-l', '--log-level',
+        type=str,
+        default='info',
+        choices=['debug', 'info', 'warn'],
+        help='sets the level for logging messsages')
+
     args = parser.parse_args()
-    main(args)
+    if not 0 <= args.leftover_ratio_pct <= 100:
+        parser.error('leftover ratio must be within [0, 100]')
+
+    if args.test_size is not None and (args.folds > 1 or args.stratify):
+        parser.error('exact test size is only supported for a single unstratified fold')
+
+    if args.strata_width is not None and (not args.stratify or args.strata_width <= 0):
+        parser.error('strata width requires stratifying and must be positive')
+
+    if args.max_strata < 1:
+        parser.error('maximum number of strata must be positive')
+
+    try:
+        main(args)
 
+    except ValueError, e:
+        logging.error(str(e))
+        sys.exit(1)
@@ -5,11 +5,23 @@ import os
 import os.path
 import sys
 import logging
-import cPickle
 import csv
 import argparse
+from itertools import islice
+from functools import partial
+from collections import deque
 
-from predict.decisiontree.forest import RandomForest
+from predict.decisiontree.forest import load_forest
+
+# rows per chunk when predicting samples one by one
+DEFAULT_CHUNK_SIZE = 1000
+
+# bound in seconds on waiting for a chunk scored by a worker process: waiting
+# with a timeout keeps the pool interruptible, python 2 hanging otherwise
+CHUNK_TIMEOUT = 24 * 3600
+
+# scoring function for a list of csv rows, inherited by the worker processes
+_score_rows = None
 
 def config_logging(level):
     # create logger
@@ -32,43 +44,57 @@ def config_logging(level):
     # add ch to logger
     logger.addHandler(ch)
 
+def load_generated(forest_path, threads):
+    """
+    Imports the scoring module generated from the forest, generating it
+    first when missing or older than the forest.
+    """
+    from predict.decisiontree import codegen
+    module_path = codegen.module_path(forest_path)
+    if codegen.is_stale(module_path, forest_path):
+        codegen.write_module(load_forest(forest_path, threads=threads).trees, module_path)
+        
+    return codegen.load_module(module_path)
+
 def main(args):
     config_logging(args.log_level)
     forest_path = args.forest
-    forest = RandomForest()
-    if os.path.isdir(forest_path):
-        only_files = [f for f in os.listdir(forest_path)
-            if os.path.isfile(os.path.join(forest_path, f)) ]
-            
-        for f in only_files:
-            with open(os.path.join(forest_path, f), 'r') as forest_file:
-                forest_data = cPickle.load(forest_file)
-                forest.use_trees(forest_data)
-            
-    else:
-        with open(forest_path, 'r') as forest_file:
-            forest_data = cPickle.load(forest_file)
-            forest.use_trees(forest_data)
-            
-    logging.info('loaded a total of %d trees' % len(forest.trees))
     samples = csv.reader(args.csv_input_file, delimiter=',')
     first_line = next(samples)
     header = first_line[1:]
+    global _score_rows
+    predict_options = dict(use_median=args.use_median, tolerance=args.tolerance, confidence=args.confidence,
+        max_trees=args.max_trees)
+    if args.python:
+        scoring_module = load_generated(forest_path, args.load_threads)
+        logging.info('loaded a total of %d trees' % len(scoring_module.TREES))
+        _score_rows = partial(score_generated, scoring_module, parsed_columns(header, scoring_module.DIMENSIONS),
+            args.use_median)
+        
+    elif args.batch_size:
+        from predict.decisiontree.compiled import load_compiled
+        compiled_forest = load_compiled(forest_path, threads=args.load_threads)
+        _score_rows = partial(score_matrix, compiled_forest, parsed_columns(header, compiled_forest.dimensions),
+            predict_options)
+        
+    else:
+        forest = load_forest(forest_path, threads=args.load_threads)
+        _score_rows = partial(score_samples, forest, parsed_columns(header, forest.dimensions), predict_options)
+        
+    chunk_size = args.batch_size or DEFAULT_CHUNK_SIZE
+    chunks = iter(lambda: list(islice(samples, chunk_size)), [])
     with open(args.output, 'wb') as output_file:
         out = csv.writer(output_file)
         out.writerow([first_line[0], args.target_column])
-        for sample_data in samples:
-            sample_id = sample_data[0]
-            sample = dict()
-            for index, column in enumerate(sample_data[1:]):
-                try:
-                    sample[header[index]] = float(column)
-
-                except ValueError:
-                    pass
-
-            value = forest.predict(sample, use_median=args.use_median)
-            out.writerow([sample_id, value])
+        if args.workers:
+            results = score_in_pool(chunks, args.workers)
+            
+        else:
+            results = (_score_rows(rows) for rows in chunks)
+            
+        for scored_rows in results:
+            out.writerows(scored_rows)
+            logging.debug('predicted %d samples' % len(scored_rows))
 
     if args.check:
         from itertools import izip
@@ -96,6 +122,108 @@ def main(args):
             
     logging.info('run completed - check results in file "%s"' % args.output)
 
+def score_in_pool(chunks, workers):
+    """
+    Scores the chunks in a pool of processes inheriting the forest, yielding
+    the results in input order. At most two chunks per process are pending
+    at any time, so that memory use does not depend on the input size.
+    """
+    import multiprocessing as mp
+    pool = mp.Pool(processes=workers)
+    pending = deque()
+    try:
+        for rows in chunks:
+            if len(pending) == 2 * workers:
+                yield pending.popleft().get(CHUNK_TIMEOUT)
+                
+            pending.append(pool.apply_async(score_chunk, (rows,)))
+            
+        while pending:
+            yield pending.popleft().get(CHUNK_TIMEOUT)
+            
+        pool.close()
+        
+    except:
+        pool.terminate()
+        raise
+        
+    finally:
+        pool.join()
+        
+def score_chunk(rows):
+    """Scores a chunk of csv rows in a worker process"""
+    return _score_rows(rows)
+
+def parsed_columns(header, dimensions):
+    """
+    Columns to be parsed for the given dimensions.
+
+    @return: list of tuples (position in the csv row, position of the dimension)
+    """
+    return [(index + 1, dimensions.index(name)) for index, name in enumerate(header) if name in dimensions]
+
+def score_matrix(compiled_forest, columns, predict_options, rows):
+    """
+    Parses the rows into a matrix, only keeping the columns used by the
+    forest, and predicts the matrix at once.
+
+    @param predict_options: keyword arguments of CompiledForest.predict_batch
+    """
+    import numpy
+    matrix = numpy.empty((len(rows), len(compiled_forest.dimensions)))
+    matrix.fill(numpy.nan)
+    for row, sample_data in enumerate(rows):
+        for position, column in columns:
+            try:
+                matrix[row, column] = float(sample_data[position])
+
+            except ValueError:
+                pass
+
+    values = compiled_forest.predict_batch(matrix, **predict_options)
+    return [[sample_data[0], None if value != value else value]
+        for sample_data, value in zip(rows, values.tolist())]
+
+def score_generated(scoring_module, columns, use_median, rows):
+    """
+    Predicts the rows one by one with a generated scoring module, only
+    parsing the columns used by the forest.
+    """
+    scored_rows = list()
+    for sample_data in rows:
+        sample = [None] * len(scoring_module.DIMENSIONS)
+        for position, column in columns:
+            try:
+                sample[column] = float(sample_data[position])
+
+            except ValueError:
+                pass
+
+        scored_rows.append([sample_data[0], scoring_module.predict(sample, use_median=use_median)])
+
+    return scored_rows
+
+def score_samples(forest, columns, predict_options, rows):
+    """
+    Predicts the rows one by one with the tree objects, only parsing the
+    columns used by the forest.
+
+    @param predict_options: keyword arguments of RandomForest.predict
+    """
+    scored_rows = list()
+    for sample_data in rows:
+        sample = [None] * len(forest.dimensions)
+        for position, column in columns:
+            try:
+                sample[column] = float(sample_data[position])
+
+            except ValueError:
+                pass
+
+        scored_rows.append([sample_data[0], forest.predict(sample, **predict_options)])
+
+    return scored_rows
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Runs a Random Forest on a set',
@@ -127,6 +255,37 @@ if __name__ == '__main__':
         action='store_true',
         help='using median for aggregating forests output')
 
+    parser.add_argument('-e', '--tolerance',
+        type=float,
+        help='stops evaluating trees once the confidence interval of the output is within this half-width')
+
+    parser.add_argument('-k', '--confidence',
+        type=float,
+        default=0.95,
+        help='confidence level of the interval compared to the tolerance')
+
+    parser.add_argument('-n', '--max-trees',
+        type=int,
+        help='maximum number of trees evaluated per sample')
+
+    parser.add_argument('-b', '--batch-size',
+        type=int,
+        default=10000,
+        help='number of samples predicted at once by the compiled forest, 0 for predicting samples one by one')
+
+    parser.add_argument('-w', '--workers',
+        type=int,
+        help='number of processes scoring chunks of samples in parallel')
+
+    parser.add_argument('-j', '--load-threads',
+        type=int,
+        default=4,
+        help='number of forest files read concurrently')
+
+    parser.add_argument('-p', '--python',
+        action='store_true',
+        help='scores with a python module generated from the forest and cached under ~/.cache/dtl-modules')
+
     parser.add_argument('-l', '--log-level',
         type=str,
         default='info',
@@ -134,4 +293,10 @@ if __name__ == '__main__':
         help='sets the level for logging messsages')
 
     args = parser.parse_args()
+    if args.python and (args.tolerance is not None or args.max_trees is not None):
+        parser.error('tolerance and maximum number of trees are not supported by generated modules')
+
+    if not 0.0 < args.confidence < 1.0:
+        parser.error('confidence level must be within ]0, 1[')
+
     main(args)
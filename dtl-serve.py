@@ -0,0 +1,166 @@
+#
+# -*- coding: utf-8 -*-
+#
+import os
+import os.path
+import sys
+import logging
+import argparse
+import BaseHTTPServer
+import SocketServer
+
+import jsonrpc
+from predict.decisiontree.compiled import load_compiled
+from predict.decisiontree.serving import MicroBatcher
+
+def config_logging(level):
+    # create logger
+    logger = logging.getLogger('training')
+    level_mapping = {
+        'debug': logging.DEBUG,
+        'info': logging.INFO,
+        'warn': logging.WARNING,
+    }
+    # root logger
+    logger.setLevel(level_mapping[level])
+    logging.getLogger().setLevel(level_mapping[level])
+
+    # create console handler and set level to debug
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+
+    # add ch to logger
+    logger.addHandler(ch)
+
+class ScoringService(object):
+
+    """
+        Methods exposed through JSON-RPC. Samples are given as objects
+        mapping dimension names to numbers, missing or null values being
+        undefined.
+    """
+
+    def __init__(self, batchers):
+        """
+        @param batchers: dictionary of MicroBatcher by forest name, the forest being optional when only one is served
+        """
+        self._batchers = batchers
+
+    def forests(self):
+        """Names of the forests being served."""
+        return sorted(self._batchers.keys())
+
+    def predict(self, sample, forest=None, use_median=False):
+        return self._batcher(forest).predict([sample], use_median=use_median)[0]
+
+    def predict_batch(self, samples, forest=None, use_median=False):
+        return self._batcher(forest).predict(samples, use_median=use_median)
+
+    def _batcher(self, forest):
+        if forest is None and len(self._batchers) == 1:
+            return self._batchers.values()[0]
+
+        return self._batchers[forest]
+
+class _Request(object):
+
+    def __init__(self, body):
+        self.body = body
+
+class _Response(object):
+
+    def __init__(self):
+        self.headers = dict()
+        self.chunks = list()
+
+    def write(self, data):
+        self.chunks.append(data)
+
+class RpcRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        response = _Response()
+        # the dispatcher keeps the response, so that one is needed per request
+        jsonrpc.Server(self.server.service).handle(_Request(body), response)
+        content = ''.join(response.chunks)
+        self.send_response(200)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+class ScoringServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RpcRequestHandler)
+        self.service = service
+
+def main(args):
+    config_logging(args.log_level)
+    batchers = dict()
+    for forest_path in args.forests:
+        name = os.path.basename(os.path.normpath(forest_path))
+        batchers[name] = MicroBatcher(load_compiled(forest_path, threads=args.load_threads),
+            max_delay=args.batch_delay / 1000.0, max_rows=args.batch_size)
+        logging.info('serving forest "%s" from %s' % (name, forest_path))
+
+    server = ScoringServer((args.host, args.port), ScoringService(batchers))
+    logging.info('listening on http://%s:%d/' % (args.host, args.port))
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serves predictions of Random Forests over JSON-RPC',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('forests',
+        type=str,
+        nargs='+',
+        help='forest data obtained from training phase: each can be a directory or a file, served under its base name')
+
+    parser.add_argument('-a', '--host',
+        type=str,
+        default='localhost',
+        help='address to listen on')
+
+    parser.add_argument('-p', '--port',
+        type=int,
+        default=8765,
+        help='port to listen on')
+
+    parser.add_argument('-d', '--batch-delay',
+        type=float,
+        default=5.0,
+        help='time in milliseconds a request waits for concurrent requests to be scored with it')
+
+    parser.add_argument('-b', '--batch-size',
+        type=int,
+        default=10000,
+        help='maximum number of samples scored at once')
+
+    parser.add_argument('-j', '--load-threads',
+        type=int,
+        default=4,
+        help='number of forest files read concurrently')
+
+    parser.add_argument('-l', '--log-level',
+        type=str,
+        default='info',
+        choices=['debug', 'info', 'warn'],
+        help='sets the level for logging messsages')
+
+    args = parser.parse_args()
+    main(args)
@@ -5,12 +5,11 @@ import os
 import os.path
 import sys
 import logging
-import cPickle
 import csv
 import argparse
 from collections import defaultdict
 
-from predict.decisiontree.forest import RandomForest
+from predict.decisiontree.forest import iter_trees
 
 def config_logging(level):
     # create logger
@@ -35,35 +34,20 @@ def config_logging(level):
 
 def main(args):
     config_logging(args.log_level)
-    forest_path = args.forest
-    forest = RandomForest()
-    if os.path.isdir(forest_path):
-        only_files = [f for f in os.listdir(forest_path)
-            if os.path.isfile(os.path.join(forest_path, f)) ]
-            
-        for f in only_files:
-            with open(os.path.join(forest_path, f), 'r') as forest_file:
-                forest_data = cPickle.load(forest_file)
-                forest.use_trees(forest_data)
-            
-    else:
-        with open(forest_path, 'r') as forest_file:
-            forest_data = cPickle.load(forest_file)
-            forest.use_trees(forest_data)
-            
-    logging.info('loaded a total of %d trees' % len(forest.trees))
-    tree_stats = list()
-    for count, root in enumerate(forest.trees):
+    # trees are processed as soon as their file is loaded
+    trees_count = 0
+    for count, root in enumerate(iter_trees(args.forest, threads=args.load_threads)):
         dimensions = defaultdict(int)
-        tree_stats.append(dimensions)
         def print_node(n):
             dimensions[n.split_dimension] += 1
             
         walk(root, print_node)
-
-    for count, ts in enumerate(tree_stats):
-        for dim in ts.keys():
-            print count, dim, ts[dim]
+        for dim in dimensions.keys():
+            print count, dim, dimensions[dim]
+            
+        trees_count += 1
+        
+    logging.info('processed a total of %d trees' % trees_count)
 
 def walk(node, f_node, f_leaf=None):
     if node.is_leaf():
@@ -84,6 +68,11 @@ if __name__ == '__main__':
         default='forest',
         help='forest data obtained from training phase: can be a directory or a file')
 
+    parser.add_argument('-j', '--load-threads',
+        type=int,
+        default=4,
+        help='number of forest files read concurrently')
+
     parser.add_argument('-l', '--log-level',
         type=str,
         default='info',
@@ -49,16 +49,34 @@ def main(args):
         with open(args.use_columns, 'r') as file_use:
             used = [line.rstrip() for line in file_use]
             
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = args.memory_budget << 20
+        
+    cache = None
+    if args.cache_dir:
+        from predict.decisiontree.cache import DatasetCache
+        cache = DatasetCache(args.cache_dir, max_size=args.cache_size << 20)
+        
     # Single processor
     factory = TrainingSetFactory()
     forests = None
     input_file = args.csv_input_file
     data = factory.train_csv(input_file, target_name=args.target_column, 
-        output_sampling=args.output_sampling, ignore_columns=ignored, use_columns=used)
+        output_sampling=args.output_sampling, ignore_columns=ignored, use_columns=used,
+        columnar=args.columnar, binned=args.binned, cache=cache,
+        memory_budget=memory_budget, workspace_dir=args.workspace_dir)
     forest = RandomForest()
     forest.set_training_data(data, args.target_column, 
-        min_count=args.min_leaf_size, split_sampling=args.split_sampling)
+        min_count=args.min_leaf_size, split_sampling=args.split_sampling,
+        split_workers=args.split_workers, bootstrap=args.bootstrap, subsample=args.subsample,
+        dimension_significance_threshold=args.significance_threshold)
     forest.grow_trees(1)
+    error, samples_count = forest.out_of_bag_error()
+    if error is not None:
+        msg_template = 'out-of-bag estimate: mean absolute error = %.2f on a total of %d samples'
+        logging.getLogger('training').info(msg_template % (error, samples_count))
+        
     forests = [forest]
     serialize_forests(forests, args.output)
         
@@ -91,13 +109,18 @@ if __name__ == '__main__':
     parser.add_argument('-y', '--split-sampling',
         type=int,
         default=100,
-        help='number of samples used when selecting a split')
+        help='number of samples used when selecting a split, 0 for assessing every distinct value')
 
     parser.add_argument('-s', '--output-sampling',
         type=int,
         default=5,
         help='number of categories for output sampling')
 
+    parser.add_argument('-g', '--significance-threshold',
+        type=float,
+        default=0.5,
+        help='minimum ratio of defined values for a dimension to be considered for splitting a node')
+
     parser.add_argument('-i', '--ignore-columns',
         type=str,
         help='file containing a list of columns to be ignored')
@@ -106,6 +129,44 @@ if __name__ == '__main__':
         type=str,
         help='file containing the list of columns to look at')
     
+    parser.add_argument('-c', '--columnar',
+        action='store_true',
+        help='loads the training set into numpy columns')
+
+    parser.add_argument('-b', '--binned',
+        action='store_true',
+        help='quantizes the training set into histogram bins at load time')
+
+    parser.add_argument('-r', '--bootstrap',
+        action='store_true',
+        help='grows the tree from rows drawn with replacement, reporting the out-of-bag error')
+
+    parser.add_argument('-p', '--subsample',
+        type=float,
+        default=1.0,
+        help='fraction of the rows drawn for growing the tree, reporting the out-of-bag error when below 1')
+
+    parser.add_argument('-e', '--memory-budget',
+        type=int,
+        help='trains from columns kept on disk, loading the rows of a node in memory below this size in megabytes')
+
+    parser.add_argument('-a', '--workspace-dir',
+        type=str,
+        help='directory of the working files when training from disk, the system temporary directory by default')
+
+    parser.add_argument('-k', '--cache-dir',
+        type=str,
+        help='directory caching the parsed training sets for later runs (requires --columnar or --binned)')
+
+    parser.add_argument('-z', '--cache-size',
+        type=int,
+        default=4096,
+        help='maximum size of the cache in megabytes, least recently used training sets being evicted')
+
+    parser.add_argument('-w', '--split-workers',
+        type=int,
+        help='assesses the dimensions of a node in parallel using local processors (requires --columnar or --binned)')
+
     parser.add_argument('-l', '--log-level',
         type=str,
         default='info',
@@ -113,5 +174,26 @@ if __name__ == '__main__':
         help='sets the level for logging messsages')
 
     args = parser.parse_args()
+    if not 0.0 < args.subsample <= 1.0:
+        parser.error('--subsample must be within ]0, 1]')
+
+    if args.memory_budget is not None and args.split_workers:
+        parser.error('--memory-budget cannot be combined with --split-workers')
+
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        parser.error('--memory-budget must be positive')
+
+    if args.memory_budget is not None and args.binned:
+        parser.error('--memory-budget cannot be combined with --binned')
+
+    if args.workspace_dir and args.memory_budget is None:
+        parser.error('--workspace-dir requires --memory-budget')
+
+    if args.memory_budget is not None and args.cache_dir:
+        parser.error('--memory-budget cannot be combined with --cache-dir')
+        
+    if args.cache_dir and not (args.columnar or args.binned):
+        parser.error('--cache-dir requires --columnar or --binned')
+        
     main(args)
 
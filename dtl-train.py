@@ -51,36 +51,77 @@ def main(args):
         with open(args.use_columns, 'r') as file_use:
             used = [line.rstrip() for line in file_use]
             
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = args.memory_budget << 20
+        
+    cache = None
+    if args.cache_dir:
+        from predict.decisiontree.cache import DatasetCache
+        cache = DatasetCache(args.cache_dir, max_size=args.cache_size << 20)
+        
     if workers_count:
         import multiprocessing as mp
+        import shutil
+        import tempfile
+        from predict.decisiontree.columnar import load_store
         mp.log_to_stderr(logging.INFO)
         logger = mp.get_logger()
-        pool = mp.Pool(processes=workers_count)
-        forests = list()
-        def gather_trees(tree_serial, f=forests):
-            tree = cPickle.loads(tree_serial)
-            forest = RandomForest()
-            forest.trees = [tree]
-            forests.append(forest)
-        
-        pool_status = list()
-        for index in range(args.number_trees):
-            status = pool.apply_async(create_tree,
-                    (args.log_level, args.csv_input_file, args.target_column, 
-                        args.min_leaf_size, args.split_sampling, args.output_sampling, ignored, used),
-                    callback=gather_trees)
-            pool_status.append(status)
+        # parsing once into a column store that every worker maps in memory
+        factory = TrainingSetFactory()
+        with open(args.csv_input_file, 'r') as input_file:
+            data = factory.train_csv(input_file, target_name=args.target_column, 
+                output_sampling=args.output_sampling, ignore_columns=ignored, use_columns=used,
+                columnar=True, binned=args.binned, cache=cache)
+                
+        if cache is not None:
+            # workers map the cached store as it is
+            store_path = data.store_directory
             
-        for s in pool_status:
-            # This is only for forcing the display of some error ...
-            # It would go unnoticed otherwise!
-            # Also note that side-effect of setting a timeout is that
-            # it works around python's bug when processes are interrupted
-            # (they would hang otherwise forcing to kill -9...)
-            s.get(args.timeout_min * 60)
-        
-        pool.close()
-        pool.join()
+        else:
+            store_path = tempfile.mkdtemp(prefix='dtl-train-')
+            
+        try:
+            if cache is None:
+                data.save(store_path)
+                
+            del data
+            pool = mp.Pool(processes=workers_count, initializer=init_worker, initargs=(store_path,))
+            forests = list()
+            # collecting out-of-bag predictions of all the trees
+            oob_forest = RandomForest()
+            oob_forest.set_training_data(load_store(store_path), args.target_column)
+            def gather_trees(result, f=forests):
+                tree_serial, oob_positions, oob_predictions = result
+                tree = cPickle.loads(tree_serial)
+                forest = RandomForest()
+                forest.trees = [tree]
+                forests.append(forest)
+                oob_forest.add_out_of_bag(oob_positions, oob_predictions)
+            
+            pool_status = list()
+            for index in range(args.number_trees):
+                status = pool.apply_async(create_tree,
+                        (args.target_column, args.min_leaf_size, args.split_sampling,
+                            args.bootstrap, args.subsample, args.significance_threshold),
+                        callback=gather_trees)
+                pool_status.append(status)
+                
+            for s in pool_status:
+                # This is only for forcing the display of some error ...
+                # It would go unnoticed otherwise!
+                # Also note that side-effect of setting a timeout is that
+                # it works around python's bug when processes are interrupted
+                # (they would hang otherwise forcing to kill -9...)
+                s.get(args.timeout_min * 60)
+            
+            pool.close()
+            pool.join()
+            log_out_of_bag_error(oob_forest)
+            
+        finally:
+            if cache is None:
+                shutil.rmtree(store_path)
         
     else:
         # Single processor
@@ -88,37 +129,63 @@ def main(args):
         forests = None
         with open(args.csv_input_file, 'r') as input_file:
             data = factory.train_csv(input_file, target_name=args.target_column, 
-                output_sampling=args.output_sampling, ignore_columns=ignored, use_columns=used)
+                output_sampling=args.output_sampling, ignore_columns=ignored, use_columns=used,
+                columnar=args.columnar, binned=args.binned, cache=cache,
+                memory_budget=memory_budget, workspace_dir=args.workspace_dir)
             forest = RandomForest()
             forest.set_training_data(data, args.target_column, 
-                min_count=args.min_leaf_size, split_sampling=args.split_sampling)
+                min_count=args.min_leaf_size, split_sampling=args.split_sampling,
+                split_workers=args.split_workers, bootstrap=args.bootstrap, subsample=args.subsample,
+                dimension_significance_threshold=args.significance_threshold)
             forest.grow_trees(args.number_trees)
+            log_out_of_bag_error(forest)
             forests = [forest]
     
     with open(args.output, 'wb') as output_file:
-        serialize_forests(forests, output_file)
+        serialize_forests(forests, output_file, shared=args.share_subtrees)
+        
+def log_out_of_bag_error(forest):
+    error, samples_count = forest.out_of_bag_error()
+    if error is not None:
+        msg_template = 'out-of-bag estimate: mean absolute error = %.2f on a total of %d samples'
+        logging.getLogger('training').info(msg_template % (error, samples_count))
         
-def create_tree(log_level, csv_input_file, target_column, min_leaf_size, 
-    split_sampling, output_sampling, ignored, used):
+# training set mapped by each worker process
+_training_set = None
+
+def init_worker(store_path):
+    """
+    Maps the column store once per worker, every tree grown by the worker
+    reusing it.
+    """
+    import random
+    import numpy
+    from predict.decisiontree.columnar import load_store
+    global _training_set
+    # forked workers would otherwise all draw the same random sequences
+    random.seed()
+    numpy.random.seed()
+    _training_set = load_store(store_path)
+    
+def create_tree(target_column, min_leaf_size, split_sampling, bootstrap, subsample, significance_threshold):
     """
-    Grows a single-tree forest
+    Grows a single-tree forest, returning the serialized tree along with its
+    out-of-bag predictions
     """
     import multiprocessing as mp
     logger = mp.get_logger()
     logger.setLevel(logging.INFO)
-    factory = TrainingSetFactory()
-    tree = None
-    with open(csv_input_file, 'r') as input_file:
-        data = factory.train_csv(input_file, target_name=target_column, output_sampling=output_sampling, ignore_columns=ignored, use_columns=used)
-        forest = RandomForest()
-        forest.set_training_data(data, target_column, min_count=min_leaf_size, split_sampling=split_sampling)
-        tree = forest.grow_tree()
+    forest = RandomForest()
+    forest.set_training_data(_training_set, target_column, min_count=min_leaf_size, split_sampling=split_sampling,
+        bootstrap=bootstrap, subsample=subsample, dimension_significance_threshold=significance_threshold)
+    tree = forest.grow_tree()
+    oob_positions, oob_predictions = forest.out_of_bag_predictions()
     
     import cPickle
     from StringIO import StringIO
     output = StringIO()
     cPickle.dump(tree, output)
-    return output.getvalue()
+    return output.getvalue(), oob_positions, oob_predictions
     
 if __name__ == '__main__':
     
@@ -145,7 +212,7 @@ if __name__ == '__main__':
 
     parser.add_argument('-m', '--multiprocessing',
         type=int,
-        help='splits the work using local processors')
+        help='splits the work using local processors, the training set being loaded once into a shared column store')
 
     parser.add_argument('-f', '--timeout-min',
         type=int,
@@ -160,13 +227,18 @@ if __name__ == '__main__':
     parser.add_argument('-y', '--split-sampling',
         type=int,
         default=20,
-        help='number of samples used when selecting a split')
+        help='number of samples used when selecting a split, 0 for assessing every distinct value')
 
     parser.add_argument('-s', '--output-sampling',
         type=int,
         default=5,
         help='number of categories for output sampling')
 
+    parser.add_argument('-g', '--significance-threshold',
+        type=float,
+        default=0.5,
+        help='minimum ratio of defined values for a dimension to be considered for splitting a node')
+
     parser.add_argument('-i', '--ignore-columns',
         type=str,
         help='file containing a list of columns to be ignored')
@@ -175,6 +247,48 @@ if __name__ == '__main__':
         type=str,
         help='file containing the list of columns to look at')
 
+    parser.add_argument('-c', '--columnar',
+        action='store_true',
+        help='loads the training set into numpy columns')
+
+    parser.add_argument('-b', '--binned',
+        action='store_true',
+        help='quantizes the training set into histogram bins at load time')
+
+    parser.add_argument('-r', '--bootstrap',
+        action='store_true',
+        help='grows each tree from rows drawn with replacement, reporting the out-of-bag error')
+
+    parser.add_argument('-p', '--subsample',
+        type=float,
+        default=1.0,
+        help='fraction of the rows drawn for growing each tree, reporting the out-of-bag error when below 1')
+
+    parser.add_argument('-e', '--memory-budget',
+        type=int,
+        help='trains from columns kept on disk, loading the rows of a node in memory below this size in megabytes')
+
+    parser.add_argument('-a', '--workspace-dir',
+        type=str,
+        help='directory of the working files when training from disk, the system temporary directory by default')
+
+    parser.add_argument('-k', '--cache-dir',
+        type=str,
+        help='directory caching the parsed training sets for later runs (requires --columnar, --binned or --multiprocessing)')
+
+    parser.add_argument('-z', '--cache-size',
+        type=int,
+        default=4096,
+        help='maximum size of the cache in megabytes, least recently used training sets being evicted')
+
+    parser.add_argument('-w', '--split-workers',
+        type=int,
+        help='assesses the dimensions of a node in parallel using local processors (requires --columnar or --binned)')
+
+    parser.add_argument('-d', '--share-subtrees',
+        action='store_true',
+        help='stores identical subtrees once across all the trees')
+
     parser.add_argument('-l', '--log-level',
         type=str,
         default='info',
@@ -182,5 +296,29 @@ if __name__ == '__main__':
         help='sets the level for logging messsages')
 
     args = parser.parse_args()
+    if args.split_workers and args.multiprocessing:
+        parser.error('--split-workers cannot be combined with --multiprocessing')
+        
+    if not 0.0 < args.subsample <= 1.0:
+        parser.error('--subsample must be within ]0, 1]')
+
+    if args.memory_budget is not None and (args.multiprocessing or args.split_workers):
+        parser.error('--memory-budget cannot be combined with --multiprocessing or --split-workers')
+
+    if args.memory_budget is not None and args.memory_budget <= 0:
+        parser.error('--memory-budget must be positive')
+
+    if args.memory_budget is not None and args.binned:
+        parser.error('--memory-budget cannot be combined with --binned')
+
+    if args.workspace_dir and args.memory_budget is None:
+        parser.error('--workspace-dir requires --memory-budget')
+
+    if args.memory_budget is not None and args.cache_dir:
+        parser.error('--memory-budget cannot be combined with --cache-dir')
+        
+    if args.cache_dir and not (args.columnar or args.binned or args.multiprocessing):
+        parser.error('--cache-dir requires --columnar, --binned or --multiprocessing')
+        
     main(args)
 
@@ -6,7 +6,12 @@ import uuid
 import urllib2
 import sys
 
-from google.appengine.ext import ndb
+try:
+    from google.appengine.ext import ndb
+
+except ImportError:
+    # outside App Engine, only Server and Client are available
+    ndb = None
 
 __author__ = 'faisal'
 
@@ -188,61 +193,63 @@ class Client(object):
             return None
 
 
-class ClientAsync(object):
+if ndb is not None:
 
-    def __init__(self, uri, headers={}):
-        self.uri = uri
-        self.headers = headers
+    class ClientAsync(object):
 
-    def __getattr__(self, key):
-        try:
-            return object.__getattr__(self, key)
-        except AttributeError:
-            return self.dispatch(key)
+        def __init__(self, uri, headers={}):
+            self.uri = uri
+            self.headers = headers
 
-    @ndb.tasklet
-    def default_async(self, *args, **kw):
-        if len(kw) > 0:
-            self.params = kw
-        elif len(args) > 0:
-            self.params = args
-        else:
-            self.params = {}
+        def __getattr__(self, key):
+            try:
+                return object.__getattr__(self, key)
+            except AttributeError:
+                return self.dispatch(key)
+
+        @ndb.tasklet
+        def default_async(self, *args, **kw):
+            if len(kw) > 0:
+                self.params = kw
+            elif len(args) > 0:
+                self.params = args
+            else:
+                self.params = {}
 
-        req = yield self.request_async()
-        raise ndb.Return(req)
+            req = yield self.request_async()
+            raise ndb.Return(req)
 
-    def dispatch(self, key):
-        self.method = key
-        return self.default_async
+        def dispatch(self, key):
+            self.method = key
+            return self.default_async
 
-    @ndb.tasklet
-    def request_async(self):
-        parameters = {
-            'id': str(uuid.uuid4()),
-            'method': self.method,
-            'params': self.params,
-            'jsonrpc': VERSION
-        }
-        data = json.dumps(parameters)
+        @ndb.tasklet
+        def request_async(self):
+            parameters = {
+                'id': str(uuid.uuid4()),
+                'method': self.method,
+                'params': self.params,
+                'jsonrpc': VERSION
+            }
+            data = json.dumps(parameters)
 
-        headers = {
-            "Content-Type": "application/json"
-        }
-        headers = dict(headers.items() + self.headers.items())
+            headers = {
+                "Content-Type": "application/json"
+            }
+            headers = dict(headers.items() + self.headers.items())
 
-        ctx = ndb.get_context()
-        response = yield ctx.urlfetch(self.uri, data, 'post', headers)
+            ctx = ndb.get_context()
+            response = yield ctx.urlfetch(self.uri, data, 'post', headers)
 
-        try:
-            result = json.loads(response.content)
-        except:
-            raise ndb.Return(None)
-
-        if 'error' in result:
-            raise Exception('%s Code: %s' % (result['error']['message'], result['error']['code']))
-        if parameters['id'] == result['id'] and 'result' in result:
-            raise ndb.Return(result['result'])
-        else:
-            raise ndb.Return(None)
+            try:
+                result = json.loads(response.content)
+            except:
+                raise ndb.Return(None)
+
+            if 'error' in result:
+                raise Exception('%s Code: %s' % (result['error']['message'], result['error']['code']))
+            if parameters['id'] == result['id'] and 'result' in result:
+                raise ndb.Return(result['result'])
+            else:
+                raise ndb.Return(None)
 
@@ -5,14 +5,22 @@ import logging
 import random
 import os
 import abc
+import threading
 
 _LOG = logging.getLogger('training')
 
+# positions of the split dimensions in the sample rows, shared by all the
+# forests of the process so that indexed nodes stay valid in any forest
+_DIMENSION_POSITIONS = dict()
+_POSITIONED_DIMENSIONS = list()
+_POSITIONS_LOCK = threading.Lock()
+
 class DecisionTreeFactory(object):
     
     def __init__(self, training_set, target, inclusion_ratio,
                  exclude, min_items_count, min_split_gain,
-                 samples_split_size, dimension_significance_threshold):
+                 samples_split_size, dimension_significance_threshold,
+                 split_workers=None):
         """
         @param training_set: full training set
         @param target: dimension to learn
@@ -20,8 +28,9 @@ class DecisionTreeFactory(object):
         @param exclude: list of dimensions to exclude from learning
         @param min_items_count: threshold for leaf size
         @param min_split_gain: minimum gain when splitting
-        @param samples_split_size: number of values to sample when considering a new split on a dimension
+        @param samples_split_size: number of values to sample when considering a new split on a dimension, 0 for all values
         @param dimension_significance_threshold: ratio of non-null values considered as significant in a given dimension
+        @param split_workers: number of processes assessing the dimensions of a node in parallel (columnar training sets only)
         """
         assert training_set.check_column(target), 'target column "%s" is missing in input dataset' % target
         self.training_set = training_set
@@ -37,101 +46,276 @@ class DecisionTreeFactory(object):
         self.dimensions_split_size = max(int(inclusion_ratio * len(self.dimensions)), 1)
         _LOG.info('the algorithm will be testing %d dimensions at each node for the best split' % self.dimensions_split_size)
         self.dimension_significance_threshold = dimension_significance_threshold
+        if _LOG.isEnabledFor(logging.DEBUG):
+            # scans every dimension, only for reporting
+            significant = [dim for dim in self.dimensions
+                if training_set.not_null_ratio(dim) >= dimension_significance_threshold]
+            _LOG.debug('%d dimensions out of %d defined for at least %.0f%% of the samples' % (len(significant),
+                len(self.dimensions), 100.0 * dimension_significance_threshold))
+
+        self.split_workers = split_workers
+        self._split_pool = None
+
+    @property
+    def split_pool(self):
+        if self._split_pool is None and self.split_workers:
+            from predict.decisiontree.parallel import SplitWorkerPool
+            self._split_pool = SplitWorkerPool(self.training_set, self.split_workers)
+            
+        return self._split_pool
 
-    def create(self):
-        root = self._create_node(self.training_set)
-        return root
+    def close(self):
+        """Stops the processes used for parallel split search, if any."""
+        if self._split_pool is not None:
+            self._split_pool.close()
+            self._split_pool = None
 
-    def _create_node(self, training_set):
+    def create(self, training_set=None):
         """
-        @param training_set: training subset at the node level
+        Grows the tree level by level from an explicit frontier of nodes
+        waiting for a split, so that the depth of the tree is not bounded by
+        the recursion limit. The frontier owns the training subsets of its
+        nodes, and the subset of a node is released as soon as its children
+        are created. The root subset stays referenced by the caller until
+        the tree is complete.
+
+        @param training_set: subset of the full training set to grow the tree from, full set by default
         """
-        set_size = training_set.count()
-        leaf_value = training_set.target_median()
-        node_entropy = training_set.target_entropy()
-        if set_size < self.min_items_count:
-            _LOG.info('low limit reached (%d), creating new leaf node for value %s' % (set_size, leaf_value))
-            node = LeafDecisionNode(leaf_value)
+        if training_set is None:
+            training_set = self.training_set
             
-        elif node_entropy == 0.:
-            _LOG.info('output identical for all %d elements, creating new leaf node for value %s' % (set_size, leaf_value))
-            node = LeafDecisionNode(leaf_value)
-        
-        else:
-            _LOG.info('splitting %d elements' % set_size)
-            best_split, best_dimension, best_value = select_split(self.dimensions,
-                training_set,
-                self.dimensions_split_size,
-                self.samples_split_size
-                )
+        root = [None]
+        def set_root(node):
+            root[0] = node
+            
+        frontier = [(training_set, set_root)]
+        del training_set
+        depth = 0
+        while frontier:
+            _LOG.info('growing level %d: %d nodes' % (depth, len(frontier)))
+            frontier = self._create_level(frontier)
+            depth += 1
+            
+        return root[0]
+
+    def _create_level(self, frontier):
+        """
+        Creates the nodes of one level of the tree, the split search being
+        batched over all the nodes of the level.
+
+        @param frontier: list of tuples (training subset, function attaching the node to its parent),
+            emptied as the nodes are consumed
+        @return: frontier for the next level
+        """
+        next_frontier = list()
+        to_split = list()
+        # consuming the frontier in order, so that the subsets of leaves are released at once
+        frontier.reverse()
+        while frontier:
+            training_set, attach = frontier.pop()
+            set_size = training_set.count()
+            leaf_value = training_set.target_median()
+            node_entropy = training_set.target_entropy()
+            if set_size < self.min_items_count:
+                _LOG.info('low limit reached (%d), creating new leaf node for value %s' % (set_size, leaf_value))
+                attach(LeafDecisionNode(leaf_value))
+                
+            elif node_entropy == 0.:
+                _LOG.info('output identical for all %d elements, creating new leaf node for value %s' % (set_size, leaf_value))
+                attach(LeafDecisionNode(leaf_value))
+            
+            else:
+                _LOG.info('splitting %d elements' % set_size)
+                to_split.append((training_set, attach))
+
+        training_set = None
+        if not to_split:
+            return next_frontier
+            
+        splits = select_splits(self.dimensions,
+            [training_set for training_set, attach in to_split],
+            self.dimensions_split_size,
+            self.samples_split_size,
+            significance_threshold=self.dimension_significance_threshold,
+            split_pool=self.split_pool
+            )
+        for position, (best_split, best_dimension, best_value) in enumerate(splits):
+            training_set, attach = to_split[position]
+            # releasing the subset once the node is done
+            to_split[position] = None
+            set_size = training_set.count()
+            leaf_value = training_set.target_median()
+            node_entropy = training_set.target_entropy()
             if best_split is None:
                 _LOG.info('no convenient split found, creating new leaf node for %d elements for value %s' % (set_size, leaf_value))
-                node = LeafDecisionNode(leaf_value)
-            else:
-                gain = 1. - best_split['score'] / node_entropy
-                _LOG.info('entropy at current node is %.4f' % (node_entropy))
-                _LOG.info('assessing split %d / %d (score %.4f) creating a gain in entropy of %.1f%%' % (best_split['left_ts'].count(), best_split['right_ts'].count(), best_split['score'], 100.0 * gain))
-                if gain <= self.min_split_gain:
-                    _LOG.info('gain too low, creating new leaf node for %d elements for value %s' % (set_size, leaf_value))
-                    node = LeafDecisionNode(leaf_value)
-                    
-                else:
-                    _LOG.info('assessment succesful: creating split')
-                    _LOG.info('creating left subnode for %d elements' % (best_split['left_ts'].count()))
-                    left_node = self._create_node(best_split['left_ts'])
-                    _LOG.info('creating right subnode for %d elements' % (best_split['right_ts'].count()))
-                    right_node = self._create_node(best_split['right_ts'])
-                    node = DecisionNode(split_value=best_value,
-                            split_dimension=best_dimension,
-                            left_node=left_node,
-                            right_node=right_node
-                            )
-
-        return node
-    
-def select_split(tree_dimensions, training_set, dimensions_split_size, samples_split_size):
+                attach(LeafDecisionNode(leaf_value))
+                continue
+                
+            gain = 1. - best_split['score'] / node_entropy
+            _LOG.info('entropy at current node is %.4f' % (node_entropy))
+            _LOG.info('assessing split on "%s" (score %.4f) creating a gain in entropy of %.1f%%' % (best_dimension, best_split['score'], 100.0 * gain))
+            if gain <= self.min_split_gain:
+                _LOG.info('gain too low, creating new leaf node for %d elements for value %s' % (set_size, leaf_value))
+                attach(LeafDecisionNode(leaf_value))
+                continue
+                
+            _LOG.info('assessment succesful: creating split')
+            split = create_split(training_set, best_dimension, best_value, seed=best_split['seed'])
+            node = DecisionNode(split_value=best_value,
+                    split_dimension=best_dimension,
+                    left_node=None,
+                    right_node=None
+                    )
+            attach(node)
+            _LOG.info('creating subnodes for %d / %d elements' % (split['left_ts'].count(), split['right_ts'].count()))
+            next_frontier.append((split['left_ts'], _attach_left(node)))
+            next_frontier.append((split['right_ts'], _attach_right(node)))
+            
+        return next_frontier
+
+def _attach_left(node):
+    def attach(child):
+        node.left_node = child
+        
+    return attach
+    
+def _attach_right(node):
+    def attach(child):
+        node.right_node = child
+        
+    return attach
+    
+def select_split(tree_dimensions, training_set, dimensions_split_size, samples_split_size,
+        significance_threshold=0.0):
     """ Restricting the dimensions prevents cross-correlation in Random Forests """
-    dimensions = random.sample(tree_dimensions, dimensions_split_size)
-    best_split = None
-    best_dimension = None
-    best_value = None
-    for dimension in dimensions:
-        (dim_split, dim_value) = assess_split(training_set, dimension, samples_split_size)
-        if dim_split and (not best_split or dim_split['score'] < best_split['score']):
-            best_split = dim_split
-            best_value = dim_value
-            best_dimension = dimension
-        
-    _LOG.debug('keeping best split "%s" (%s)' % (best_dimension, best_value))
+    best_split, best_dimension, best_value = select_splits(tree_dimensions, [training_set],
+        dimensions_split_size, samples_split_size, significance_threshold=significance_threshold)[0]
+    if best_split is not None:
+        # child tables are only built for the winning split
+        best_split = create_split(training_set, best_dimension, best_value, seed=best_split['seed'])
+        
     return (best_split, best_dimension, best_value)
 
-def assess_split(training_set, dimension, size):
+def select_splits(tree_dimensions, training_sets, dimensions_split_size, samples_split_size,
+        significance_threshold=0.0, split_pool=None):
     """
-    Assessing the effect of N random splits along dimension.
+    Scores the best split of each of several training subsets in one batch,
+    without building the child tables.
+
+    @param training_sets: subsets sharing the same underlying data
+    @param significance_threshold: minimum ratio of defined values for a dimension to be drawn
+    @param split_pool: pool of processes scoring the splits, see parallel.SplitWorkerPool
+    @return: list of tuples (score-only split, dimension, value), one per subset
     """
-    _LOG.debug('testing split value on dimension %s for %d samples' % (dimension, size))
-    best_split = None
-    best_value = None
-    candidate_values = training_set.sample_measures(dimension, size)
-    for split_value in candidate_values:
-        if split_value is None:
+    requests = list()
+    owners = list()
+    for position, training_set in enumerate(training_sets):
+        dimensions = draw_dimensions(training_set, tree_dimensions, dimensions_split_size, significance_threshold)
+        for dimension in dimensions:
+            request = split_request(training_set, dimension, samples_split_size)
+            if request is not None:
+                requests.append(request)
+                owners.append(position)
+
+    results = list()
+    for training_set in training_sets:
+        results.append((None, None, None))
+        
+    if not requests:
+        return results
+        
+    if split_pool is None:
+        split_pool = training_sets[0]
+        
+    scores = split_pool.sweep_splits(requests)
+    for position, request, (dim_value, dim_score) in zip(owners, requests, scores):
+        if dim_value is None:
             continue
             
-        _LOG.debug('testing split value %s' % split_value)
-        split = create_split(training_set, dimension, split_value)
-        _LOG.debug('resulting split %s' % split)
-        if not best_split or split['score'] < best_split['score']:
-            best_split = split
-            best_value = split_value
+        best_split = results[position][0]
+        if not best_split or dim_score < best_split['score']:
+            dim_split = {
+                'score': dim_score,
+                'seed': request[3]
+            }
+            results[position] = (dim_split, request[1], dim_value)
+        
+    for best_split, best_dimension, best_value in results:
+        _LOG.debug('keeping best split "%s" (%s)' % (best_dimension, best_value))
+        
+    return results
+
+def draw_dimensions(training_set, tree_dimensions, size, significance_threshold):
+    """
+    Draws at random up to size dimensions among the ones defined for a
+    large enough ratio of the rows of training_set. Ratios are only
+    counted for the dimensions examined until enough are drawn.
+
+    @param significance_threshold: minimum ratio of defined values, 0 for drawing among all dimensions
+    """
+    if not significance_threshold:
+        return random.sample(tree_dimensions, size)
+        
+    dimensions = list()
+    for dimension in random.sample(tree_dimensions, len(tree_dimensions)):
+        if training_set.not_null_ratio(dimension) >= significance_threshold:
+            dimensions.append(dimension)
+            if len(dimensions) == size:
+                break
+                
+        else:
+            _LOG.debug('skipping dimension %s, not significant for %d samples' % (dimension, training_set.count()))
             
-    return best_split, best_value
+    return dimensions
     
-def create_split(training_set, dimension, split_value):
+def split_request(training_set, dimension, size):
+    """
+    Prepares the assessment of N candidate splits along dimension, taken from
+    the quantiles of the dimension, or of every possible split when size is 0.
+
+    @return: tuple (training set, dimension, candidate values, seed) or None when there is nothing to assess
+    """
+    _LOG.debug('testing split value on dimension %s for %d samples' % (dimension, size))
+    candidate_values = None
+    if size:
+        candidate_values = training_set.candidate_values(dimension, size)
+        if len(candidate_values) == 0:
+            return None
+
+    seed = random.getrandbits(32)
+    return (training_set, dimension, candidate_values, seed)
+
+def assess_split(training_set, dimension, size):
+    """
+    Assessing the effect of N random splits along dimension, or of every
+    possible split when size is 0. Only the score of the best split is
+    computed, along with the seed used for randomly assigning the rows where
+    the dimension is undefined.
+    """
+    request = split_request(training_set, dimension, size)
+    if request is None:
+        return None, None
+        
+    training_set, dimension, candidate_values, seed = request
+    best_value, best_score = training_set.sweep_split(dimension, candidate_values, seed=seed)
+    if best_value is None:
+        return None, None
+
+    best_split = {
+        'score': best_score,
+        'seed': seed
+    }
+    _LOG.debug('resulting split %s for value %s' % (best_split, best_value))
+    return best_split, best_value
+
+def create_split(training_set, dimension, split_value, seed=None):
     """
     Splits the provided set along dimension based on split_value.
+
+    @param seed: seed for assigning the rows where dimension is undefined, as used when scoring the split
     """
     left_ts, right_ts, null_ts = training_set.split(dimension, split_value)
-    null_ts.random_split(left_ts, right_ts)
+    null_ts.random_split(left_ts, right_ts, seed=seed)
     
     if left_ts.count() == 0 or right_ts.count() == 0:
         score = training_set.target_entropy() # score left unchanged
@@ -153,9 +337,208 @@ def create_split(training_set, dimension, split_value):
     }
     return split
     
+def dimension_position(dimension):
+    """
+    Position of a dimension in the sample rows, dimensions being positioned
+    in the order they are first met. Positions never change, whatever the
+    forest the dimension is met in.
+    """
+    position = _DIMENSION_POSITIONS.get(dimension)
+    if position is None:
+        with _POSITIONS_LOCK:
+            position = _DIMENSION_POSITIONS.get(dimension)
+            if position is None:
+                position = len(_POSITIONED_DIMENSIONS)
+                _POSITIONED_DIMENSIONS.append(dimension)
+                _DIMENSION_POSITIONS[dimension] = position
+
+    return position
+
+def positioned_dimensions(mask):
+    """
+    Dimensions of the sample rows up to the highest position set in a mask,
+    see dimension_position, None for the positions not set in the mask
+    """
+    return [dimension if mask >> position & 1 else None
+        for position, dimension in enumerate(_POSITIONED_DIMENSIONS[:mask.bit_length()])]
+
+def index_subtrees(tree):
+    """
+    Stores in each node of the tree the position of its split dimension in
+    the sample rows, the prediction for samples where none of the dimensions
+    split on within the subtree is defined, and the bit mask of the
+    positions of these dimensions. Such samples are then predicted without
+    descending into the subtree, see BaseDecisionNode.predict_row. Positions
+    are shared by all the forests, see dimension_position, so that nodes
+    indexed once are valid in every forest holding them.
+
+    @return: bit mask of the positions of the split dimensions of the tree
+    """
+    pending = [(tree, False)]
+    while pending:
+        node, children_done = pending.pop()
+        if node.is_leaf() or node.subtree_mask is not None:
+            continue
+            
+        if not children_done:
+            pending.append((node, True))
+            pending.append((node.right_node, False))
+            pending.append((node.left_node, False))
+            continue
+            
+        node.feature = dimension_position(node.split_dimension)
+        left_value = node.left_node.missing_value
+        right_value = node.right_node.missing_value
+        if left_value is None or right_value is None:
+            node.missing_value = None
+            
+        else:
+            node.missing_value = 0.5 * (left_value + right_value)
+            
+        node.subtree_mask = node.left_node.subtree_mask | node.right_node.subtree_mask | (1 << node.feature)
+        
+    return tree.subtree_mask
+
+def share_subtrees(trees):
+    """
+    Merges identical subtrees across the trees, turning the forest into a
+    directed acyclic graph: subtrees splitting on the same dimension and
+    value with identical children, and leaves with the same value, are all
+    replaced by a single node. Children are relinked in place.
+
+    @param trees: root nodes of the trees
+    @return: list of root nodes, in the same order
+    """
+    # canonical node by key, children being identified by their canonical node
+    canonical = dict()
+    # canonical node of each node already visited
+    merged = dict()
+    roots = list()
+    for tree in trees:
+        pending = [(tree, False)]
+        while pending:
+            node, children_done = pending.pop()
+            if id(node) in merged:
+                continue
+                
+            if node.is_leaf():
+                key = (node.leaf_value,)
+                
+            elif not children_done:
+                pending.append((node, True))
+                pending.append((node.right_node, False))
+                pending.append((node.left_node, False))
+                continue
+                
+            else:
+                node.left_node = merged[id(node.left_node)]
+                node.right_node = merged[id(node.right_node)]
+                key = (node.split_dimension, node.split_value, id(node.left_node), id(node.right_node))
+                
+            merged[id(node)] = canonical.setdefault(key, node)
+            
+        roots.append(merged[id(tree)])
+        
+    _LOG.info('merged %d nodes into %d shared nodes' % (len(merged), len(canonical)))
+    return roots
+    
+def flatten_trees(trees):
+    """
+    Numbers the nodes of the trees depth first, left before right, and
+    lists their attributes by node number. A node's children are always
+    numbered after it. Nodes shared by several parents, see share_subtrees,
+    are listed once.
+
+    @param trees: root nodes of the trees
+    @return: tuple (dimensions, roots, features, thresholds, lefts, rights, values): split
+        dimensions, node number of each tree root and, for each node, the position of the split
+        dimension (-1 for leaves), split value, left and right child numbers (-1 for leaves)
+        and leaf value (None for split nodes)
+    """
+    # nodes in post-order, last tree and right child first, so that the
+    # reversed list follows the trees in order, parents before children
+    ordered = list()
+    positions = dict()
+    for tree in reversed(trees):
+        pending = [(tree, False)]
+        while pending:
+            node, children_done = pending.pop()
+            if id(node) in positions:
+                continue
+                
+            if not node.is_leaf() and not children_done:
+                pending.append((node, True))
+                pending.append((node.left_node, False))
+                pending.append((node.right_node, False))
+                continue
+                
+            positions[id(node)] = len(ordered)
+            ordered.append(node)
+            
+    last = len(ordered) - 1
+    dimensions = list()
+    dimension_index = dict()
+    features = list()
+    thresholds = list()
+    lefts = list()
+    rights = list()
+    values = list()
+    for node in reversed(ordered):
+        if node.is_leaf():
+            features.append(-1)
+            thresholds.append(None)
+            lefts.append(-1)
+            rights.append(-1)
+            values.append(node.leaf_value)
+            continue
+            
+        if node.split_dimension not in dimension_index:
+            dimension_index[node.split_dimension] = len(dimensions)
+            dimensions.append(node.split_dimension)
+            
+        features.append(dimension_index[node.split_dimension])
+        thresholds.append(node.split_value)
+        lefts.append(last - positions[id(node.left_node)])
+        rights.append(last - positions[id(node.right_node)])
+        values.append(None)
+        
+    roots = [last - positions[id(tree)] for tree in trees]
+    return dimensions, roots, features, thresholds, lefts, rights, values
+
+def build_trees(dimensions, roots, features, thresholds, lefts, rights, values):
+    """
+    Rebuilds the node objects from the lists given by flatten_trees.
+
+    @return: list of root nodes
+    """
+    nodes = [None] * len(features)
+    # children being numbered after their parent
+    for number in xrange(len(features) - 1, -1, -1):
+        if features[number] < 0:
+            nodes[number] = LeafDecisionNode(values[number])
+
+        else:
+            nodes[number] = DecisionNode(split_value=thresholds[number],
+                split_dimension=dimensions[features[number]],
+                left_node=nodes[lefts[number]],
+                right_node=nodes[rights[number]])
+
+    return [nodes[root] for root in roots]
+
+def row_mask(row):
+    """Bit mask of the positions of the defined values of a sample row"""
+    mask = 0
+    for position, value in enumerate(row):
+        if value is not None:
+            mask |= 1 << position
+            
+    return mask
+    
 class BaseDecisionNode(object):
     __metaclass__ = abc.ABCMeta
     
+    __slots__ = ()
+    
     @abc.abstractmethod
     def is_leaf(self):
         """ Marker for leaves"""
@@ -180,8 +563,39 @@ class BaseDecisionNode(object):
                 right_node_value = self.right_node.predict(sample)
                 return 0.5 * (left_node_value + right_node_value) 
          
+    def predict_row(self, row, mask):
+        """
+        Predicts the regressand value for a sample given as a sequence of
+        values, None for undefined values, once the tree was prepared by
+        index_subtrees.
+
+        @param row: values ordered by dimension position, see index_subtrees
+        @param mask: bit mask of the defined values of row, see row_mask
+        """
+        node = self
+        while not node.is_leaf():
+            value = row[node.feature]
+            if value is None:
+                if not node.subtree_mask & mask:
+                    # none of the dimensions of the subtree is defined
+                    return node.missing_value
+                    
+                return 0.5 * (node.left_node.predict_row(row, mask) + node.right_node.predict_row(row, mask))
+                
+            if value <= node.split_value:
+                node = node.left_node
+                
+            else:
+                node = node.right_node
+                
+        return node.leaf_value
+        
 class LeafDecisionNode(BaseDecisionNode):
     
+    __slots__ = ('leaf_value',)
+    
+    subtree_mask = 0
+    
     def __init__(self, leaf_value):
         """
         Creates a new leaf node for a decision tree
@@ -189,6 +603,20 @@ class LeafDecisionNode(BaseDecisionNode):
         super(LeafDecisionNode, self).__init__()
         self.leaf_value = leaf_value
         
+    def __getstate__(self):
+        return (self.leaf_value,)
+        
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before nodes were slotted
+            state = (state['leaf_value'],)
+            
+        self.leaf_value, = state
+        
+    @property
+    def missing_value(self):
+        return self.leaf_value
+        
     def is_leaf(self):
         """ Marker for leaves"""
         return True
@@ -200,17 +628,30 @@ class DecisionNode(BaseDecisionNode):
     before starting the testing phase.
     """
     
+    # feature, missing_value and subtree_mask are set by index_subtrees
+    __slots__ = ('split_value', 'split_dimension', 'left_node', 'right_node',
+        'feature', 'missing_value', 'subtree_mask')
+    
     def __init__(self, split_value, split_dimension, left_node, right_node):
         """
         Creates a new node for a decision tree
         """
         super(DecisionNode, self).__init__()
-        self.split_value = split_value
-        self.split_dimension = split_dimension
-        self.left_node = left_node
-        self.right_node = right_node
+        self.__setstate__((split_value, split_dimension, left_node, right_node))
+        
+    def __getstate__(self):
+        return (self.split_value, self.split_dimension, self.left_node, self.right_node)
+        
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before nodes were slotted
+            state = (state['split_value'], state['split_dimension'], state['left_node'], state['right_node'])
+            
+        self.split_value, self.split_dimension, self.left_node, self.right_node = state
+        self.feature = None
+        self.missing_value = None
+        self.subtree_mask = None
         
     def is_leaf(self):
         """ Marker for leaves"""
         return False
-        
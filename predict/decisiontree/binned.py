@@ -0,0 +1,272 @@
+#
+# -*- coding: utf-8 -*-
+#
+import logging
+_LOG = logging.getLogger('training')
+
+import random
+
+import numpy
+
+from predict.decisiontree import tools
+from predict.decisiontree.train import BaseTrainingSet
+from predict.decisiontree.columnar import ColumnarTrainingSet
+from predict.decisiontree.columnar import histogram_scores
+from predict.decisiontree.columnar import random_sides
+
+# one code is kept for undefined values
+MAX_BINS = 255
+MISSING_CODE = 255
+
+def quantize(values, max_bins=MAX_BINS):
+    """
+    Quantizes a column into at most max_bins bins.
+
+    Bin edges are taken among the values of the column so that any edge can
+    be used as a split value: a value v falls into bin b if
+    edges[b - 1] < v <= edges[b].
+
+    @return: tuple (uint8 codes, float64 edges)
+    """
+    is_null = numpy.isnan(values)
+    not_null = numpy.sort(values[~is_null])
+    if len(not_null) == 0:
+        edges = numpy.zeros(0)
+
+    else:
+        edges = numpy.unique(not_null)
+        if len(edges) > max_bins:
+            positions = numpy.linspace(0, len(not_null) - 1, max_bins).astype(numpy.intp)
+            edges = numpy.unique(not_null[positions])
+
+    codes = numpy.empty(len(values), dtype=numpy.uint8)
+    codes[~is_null] = numpy.searchsorted(edges, values[~is_null], side='left')
+    codes[is_null] = MISSING_CODE
+    return codes, edges
+
+class BinnedTrainingSet(ColumnarTrainingSet):
+
+    """
+        Training set where each dimension is quantized once at load time into
+        uint8 bin codes. Splits are searched over per-bin histograms of the
+        output, and the histograms of the larger child of a split are
+        obtained by subtracting the smaller child's ones from the parent's.
+    """
+
+    def __init__(self):
+        super(BinnedTrainingSet, self).__init__()
+        self._codes = None
+        self._edges = None
+        self._histograms = dict()
+        self._parent_histograms = None
+        self._sibling = None
+
+    def setup_output(self, output_column_name, output_sampling):
+        super(BinnedTrainingSet, self).setup_output(output_column_name, output_sampling)
+        self._codes = dict()
+        self._edges = dict()
+        for dim in self._dimensions:
+            if dim == output_column_name:
+                continue
+
+            self._codes[dim], self._edges[dim] = quantize(self._columns[dim])
+            _LOG.debug('dimension %s quantized into %d bins' % (dim, len(self._edges[dim])))
+            del self._columns[dim]
+
+    def _store_arrays(self):
+        arrays = super(BinnedTrainingSet, self)._store_arrays()
+        for dim in self._codes.keys():
+            arrays['codes:' + dim] = self._codes[dim]
+            arrays['edges:' + dim] = self._edges[dim]
+
+        return arrays
+
+    def _restore(self, index, arrays):
+        super(BinnedTrainingSet, self)._restore(index, arrays)
+        self._codes = dict()
+        self._edges = dict()
+        for key, values in arrays.items():
+            if key.startswith('codes:'):
+                self._codes[key[len('codes:'):]] = values
+
+            elif key.startswith('edges:'):
+                self._edges[key[len('edges:'):]] = values
+
+    def split(self, dim_key, split_value):
+        """Split according to a given dimension and a split value.
+        Returns a 3-uple of tables: one for values <= split_value, one for
+        values > split_val and one for undef values of the dimension.
+
+        @param dimension: dimension to split on
+        @param split_value: split value
+
+        """
+        codes = self._codes[dim_key][self._rows]
+        split_code = numpy.searchsorted(self._edges[dim_key], split_value, side='right') - 1
+        is_null = codes == MISSING_CODE
+        is_left = codes <= split_code
+        left_table = self._create_child_table(self._rows[is_left])
+        right_table = self._create_child_table(self._rows[~is_left & ~is_null])
+        null_table = self._create_child_table(self._rows[is_null])
+        left_table._sibling = right_table
+        right_table._sibling = left_table
+        self._set_split_counts(dim_key, left_table, right_table, null_table)
+        return left_table, right_table, null_table
+
+    def sweep_split(self, dim_key, candidate_values=None, seed=None):
+        """
+        Scores the splits along a dimension from the cumulated histograms of
+        the output per bin. Rows where the dimension is undefined are randomly
+        assigned to either side once for all the thresholds, as random_split
+        would do for the same seed.
+
+        @param dim_key: dimension to split on
+        @param candidate_values: set of thresholds to be scored, all bins when None
+        @param seed: seed for assigning the rows where the dimension is undefined
+        @return: tuple (best value, best score)
+        """
+        edges = self._edges[dim_key]
+        bins = len(edges)
+        if bins == 0:
+            return None, None
+
+        histogram = self._histogram(dim_key)
+        null_hist = histogram[MISSING_CODE]
+        null_left = numpy.zeros_like(null_hist)
+        if null_hist.any():
+            null_rows = self._rows[self._codes[dim_key][self._rows] == MISSING_CODE]
+            null_codes = self._target_codes_column[null_rows]
+            null_left = numpy.bincount(null_codes[random_sides(len(null_rows), seed)],
+                minlength=len(null_hist))
+
+        cumulated = numpy.cumsum(histogram[:bins], axis=0)
+        total_hist = cumulated[-1] + null_hist
+        left_hist = cumulated + null_left
+        right_hist = total_hist - left_hist
+        if candidate_values is None:
+            candidates = numpy.flatnonzero(histogram[:bins].sum(axis=1))
+
+        else:
+            candidates = numpy.unique(numpy.searchsorted(edges, list(candidate_values), side='right') - 1)
+            candidates = candidates[candidates >= 0]
+
+        if len(candidates) == 0:
+            return None, None
+
+        scores = histogram_scores(left_hist[candidates], right_hist[candidates], self.target_bins(),
+            self.target_entropy())
+        best = numpy.argmin(scores)
+        return float(edges[candidates[best]]), float(scores[best])
+
+    def sweep_splits(self, requests):
+        """
+        Scores the splits of several tables sharing the data of this table,
+        from the histograms of each table.
+        """
+        return BaseTrainingSet.sweep_splits(self, requests)
+
+    def build_sketches(self, size):
+        """Bin edges already are quantiles of each dimension."""
+        for dim, edges in self._edges.items():
+            sketch = edges.tolist()
+            if len(sketch) > size:
+                sketch = sorted(set(tools.spread(sketch, size - 1) + sketch[-1:]))
+
+            self._sketches[dim] = sketch
+
+    def _measure_range(self, dim_key):
+        codes = self._codes[dim_key][self._rows]
+        codes = codes[codes != MISSING_CODE]
+        if len(codes) == 0:
+            return None, None
+
+        return self._edge(dim_key, codes.min()), self._edge(dim_key, codes.max())
+
+    def sorted_measures(self, dim_key):
+        codes = self._codes[dim_key][self._rows]
+        target_codes = self._target_codes_column[self._rows]
+        is_null = codes == MISSING_CODE
+        order = numpy.argsort(codes[~is_null], kind='mergesort')
+        measures = self._edges[dim_key][codes[~is_null][order]]
+        return measures.tolist(), self._codes_list(target_codes[~is_null][order]), self._codes_list(target_codes[is_null])
+
+    def sample_measures(self, dim_key, sample_size):
+        """
+        Samples uniformly at random from the set of values of a dimension.
+
+        @param dimension: the dimension
+        @param sample_size: number of values to sample
+
+        """
+        sample_size = min(sample_size, self.count())
+        positions = random.sample(xrange(self.count()), sample_size)
+        codes = self._codes[dim_key][self._rows[positions]]
+        return [self._edge(dim_key, code) for code in codes]
+
+    def _get_measure(self, item, dim_key):
+        if dim_key == self._output_column:
+            return super(BinnedTrainingSet, self)._get_measure(item, dim_key)
+
+        return self._edge(dim_key, self._codes[dim_key][item])
+
+    def _gathered_values(self, dim_key, rows):
+        if dim_key == self._output_column:
+            return super(BinnedTrainingSet, self)._gathered_values(dim_key, rows)
+
+        # undefined values are looked up past the last edge
+        edges = numpy.append(numpy.asarray(self._edges[dim_key], dtype=numpy.float64), numpy.nan)
+        codes = self._codes[dim_key][rows]
+        return edges[numpy.where(codes == MISSING_CODE, len(edges) - 1, codes)]
+
+    def _count_not_null(self, dim_key):
+        return int(numpy.count_nonzero(self._codes[dim_key][self._rows] != MISSING_CODE))
+
+    def _edge(self, dim_key, code):
+        if code == MISSING_CODE:
+            return None
+
+        return float(self._edges[dim_key][code])
+
+    def _histogram(self, dim_key):
+        """
+        Counts of rows per bin of the dimension and bin of the output.
+        """
+        if dim_key not in self._histograms:
+            sibling = self._sibling
+            parent = self._parent_histograms
+            if parent is not None and dim_key in parent and sibling is not None \
+                    and (sibling.count(), id(sibling)) < (self.count(), id(self)):
+                histogram = parent[dim_key] - sibling._histogram(dim_key)
+
+            else:
+                width = self.target_bins() + 1
+                cells = self._codes[dim_key][self._rows].astype(numpy.intp) * width \
+                    + self._target_codes_column[self._rows]
+                histogram = numpy.bincount(cells, minlength=(MISSING_CODE + 1) * width)
+                histogram = histogram.reshape((MISSING_CODE + 1, width))
+
+            self._histograms[dim_key] = histogram
+
+        return self._histograms[dim_key]
+
+    def _create_child_table(self, rows=None):
+        ts = BinnedTrainingSet()
+        # inheriting parent data
+        ts._dimensions = self._dimensions
+        ts._output_column = self._output_column
+        ts._output_sampling = self._output_sampling
+        ts._output_min = self._output_min
+        ts._output_max = self._output_max
+        ts._binary_output = self._binary_output
+        ts._index = self._index
+        ts._columns = self._columns
+        ts._codes = self._codes
+        ts._edges = self._edges
+        ts._target_codes_column = self._target_codes_column
+        ts._sketches = self._sketches
+        ts._parent_histograms = self._histograms
+        if rows is None:
+            rows = numpy.arange(0)
+
+        ts._rows = rows
+        return ts
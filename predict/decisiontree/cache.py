@@ -0,0 +1,155 @@
+#
+# -*- coding: utf-8 -*-
+#
+import logging
+_LOG = logging.getLogger('training')
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from predict.decisiontree.columnar import STORE_INDEX
+from predict.decisiontree.columnar import load_store
+
+# bumped whenever the parsing or the store layout changes, invalidating the entries
+CACHE_VERSION = 2
+# bytes read at each end of a csv file for its fingerprint
+FINGERPRINT_SIZE = 1 << 16
+
+def fingerprint(input_file):
+    """
+    Identifies the content of a csv file from its path, size, modification
+    time and first and last bytes, leaving the file position unchanged.
+    """
+    status = os.fstat(input_file.fileno())
+    position = input_file.tell()
+    digest = hashlib.sha1()
+    try:
+        input_file.seek(0)
+        digest.update(input_file.read(FINGERPRINT_SIZE))
+        input_file.seek(max(status.st_size - FINGERPRINT_SIZE, 0))
+        digest.update(input_file.read(FINGERPRINT_SIZE))
+
+    finally:
+        input_file.seek(position)
+
+    return {
+        'path': os.path.abspath(input_file.name),
+        'size': status.st_size,
+        'mtime': status.st_mtime,
+        'digest': digest.hexdigest()
+    }
+
+class DatasetCache(object):
+
+    """
+        Directory of column stores, see ColumnarTrainingSet.save, each holding
+        a parsed csv file. Entries are keyed by the fingerprint of the file
+        along with the parsing options, and the least recently used ones are
+        evicted once the cache exceeds its maximum size.
+    """
+
+    def __init__(self, directory, max_size=4 << 30):
+        """
+        @param directory: cache location, created when missing
+        @param max_size: maximum size of the cache in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, input_file, **options):
+        """
+        @param input_file: csv file opened for reading
+        @param options: parsing options the content of the store depends on
+        @return: entry name
+        """
+        description = {
+            'version': CACHE_VERSION,
+            'file': fingerprint(input_file),
+            'options': options
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+    def load(self, key):
+        """
+        Maps the store of an entry, marking it as recently used.
+
+        @return: training set, None when the entry is missing
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(os.path.join(path, STORE_INDEX)):
+            return None
+
+        os.utime(os.path.join(path, STORE_INDEX), None)
+        _LOG.info('training set found in cache %s' % path)
+        return load_store(path)
+
+    def store(self, key, training_set):
+        """
+        Writes the store of a training set as a new entry, then evicts the
+        least recently used entries. The store is written aside and renamed,
+        so that concurrent runs never map a partial entry.
+
+        @return: training set mapped from the entry
+        """
+        path = os.path.join(self.directory, key)
+        pending_path = tempfile.mkdtemp(prefix='.%s-' % key, dir=self.directory)
+        renamed = False
+        try:
+            training_set.save(pending_path)
+            os.rename(pending_path, path)
+            renamed = True
+            _LOG.info('training set cached into %s' % path)
+
+        except OSError:
+            # entry written meanwhile by another run
+            if not os.path.exists(os.path.join(path, STORE_INDEX)):
+                raise
+
+        finally:
+            # whatever failed, including the IOError of a failed write
+            if not renamed:
+                shutil.rmtree(pending_path, ignore_errors=True)
+
+        self.evict(keep=key)
+        return load_store(path)
+
+    def entries(self):
+        """
+        @return: list of tuples (last use time, size in bytes, key) of the complete entries
+        """
+        entries = list()
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.exists(os.path.join(path, STORE_INDEX)):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(os.path.join(path, STORE_INDEX)), size, key))
+
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits its
+        maximum size. Processes still mapping a removed store keep their
+        mapping.
+
+        @param keep: entry never evicted
+        """
+        entries = sorted(self.entries())
+        total_size = sum(size for last_use, size, key in entries)
+        for last_use, size, key in entries:
+            if total_size <= self.max_size:
+                break
+
+            if key == keep:
+                continue
+
+            _LOG.info('evicting cached training set %s' % key)
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total_size -= size
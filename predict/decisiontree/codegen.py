@@ -0,0 +1,212 @@
+#
+# -*- coding: utf-8 -*-
+#
+import os
+import imp
+import hashlib
+import py_compile
+import logging
+_LOG = logging.getLogger('training')
+
+from predict.decisiontree import flatten_trees
+
+# levels of a tree inlined in each generated function, bounding the nesting
+# of the generated blocks
+INLINE_DEPTH = 12
+
+# directory of the generated modules, kept apart from the forest files
+MODULE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'dtl-modules')
+
+_RUNTIME = '''
+def _walk(node, x, m):
+    """
+    Walks the node tables when a split dimension is undefined, m being the
+    bit mask of the defined values of x.
+    """
+    if not _MASKS[node] & m:
+        # none of the dimensions of the subtree is defined
+        return _MISSING_VALUES[node]
+
+    feature = _FEATURES[node]
+    value = x[feature]
+    if value is None:
+        return 0.5 * (_walk(_LEFTS[node], x, m) + _walk(_RIGHTS[node], x, m))
+
+    if value <= _THRESHOLDS[node]:
+        return _walk(_LEFTS[node], x, m)
+
+    return _walk(_RIGHTS[node], x, m)
+
+def predict(x, use_median=False):
+    """
+    Predicts the regressand for a sample given as a sequence of values
+    ordered as DIMENSIONS, None for undefined values.
+    """
+    m = 0
+    for position, value in enumerate(x):
+        if value is not None:
+            m |= 1 << position
+
+    predictions = [prediction for prediction in (tree(x, m) for tree in TREES) if prediction is not None]
+    if len(predictions) == 0:
+        return None
+
+    if use_median:
+        predictions.sort()
+        middle = len(predictions) / 2
+        if len(predictions) & 1:
+            return predictions[middle]
+
+        return 0.5 * (predictions[middle - 1] + predictions[middle])
+
+    return float(sum(predictions)) / len(predictions)
+'''
+
+def generate_source(trees):
+    """
+    Python source of a module scoring samples with the given trees, each
+    tree being emitted as nested if/else blocks. Split dimensions are
+    replaced by positions in the sequence of values of a sample.
+
+    @param trees: root nodes of the trees, see BaseDecisionNode
+    @return: source code as a string
+    """
+    dimensions, roots, features, thresholds, lefts, rights, values = flatten_trees(trees)
+    # subtree aggregates, children being numbered after their parent
+    missing_values = list(values)
+    masks = [0] * len(features)
+    for number in xrange(len(features) - 1, -1, -1):
+        if features[number] < 0:
+            continue
+
+        left_value = missing_values[lefts[number]]
+        right_value = missing_values[rights[number]]
+        if left_value is not None and right_value is not None:
+            missing_values[number] = 0.5 * (left_value + right_value)
+
+        masks[number] = masks[lefts[number]] | masks[rights[number]] | (1 << features[number])
+
+    lines = [
+        '#',
+        '# -*- coding: utf-8 -*-',
+        '#',
+        '# generated by predict.decisiontree.codegen, do not edit',
+        '#',
+        # names of the infinite and undefined floats as written by %r
+        "inf = float('inf')",
+        "nan = float('nan')",
+        'DIMENSIONS = %r' % (dimensions,),
+        '_FEATURES = %r' % (tuple(features),),
+        '_THRESHOLDS = %r' % (tuple(thresholds),),
+        '_LEFTS = %r' % (tuple(lefts),),
+        '_RIGHTS = %r' % (tuple(rights),),
+        '_MISSING_VALUES = %r' % (tuple(missing_values),),
+        '_MASKS = %r' % (tuple(masks),),
+        _RUNTIME
+        ]
+    tables = (features, thresholds, lefts, rights, values)
+    pending = list(roots)
+    emitted = set()
+    while pending:
+        number = pending.pop()
+        if number in emitted:
+            continue
+
+        emitted.add(number)
+        lines.append('def _n%d(x, m):' % number)
+        pending.extend(_emit_node(number, lines, 0, tables))
+        lines.append('')
+
+    lines.append('TREES = (%s)' % ''.join('_n%d, ' % number for number in roots))
+    lines.append('')
+    return '\n'.join(lines)
+
+def _emit_node(number, lines, depth, tables):
+    """
+    Appends the body of a subtree to lines, down to INLINE_DEPTH levels.
+
+    @return: numbers of the nodes left to emit as separate functions
+    """
+    features, thresholds, lefts, rights, values = tables
+    indent = '    ' * (depth + 1)
+    if features[number] < 0:
+        lines.append('%sreturn %r' % (indent, values[number]))
+        return []
+
+    if depth == INLINE_DEPTH:
+        lines.append('%sreturn _n%d(x, m)' % (indent, number))
+        return [number]
+
+    lines.append('%sv = x[%d]' % (indent, features[number]))
+    lines.append('%sif v is None:' % indent)
+    lines.append('%s    return _walk(%d, x, m)' % (indent, number))
+    lines.append('%sif v <= %r:' % (indent, thresholds[number]))
+    remaining = _emit_node(lefts[number], lines, depth + 1, tables)
+    lines.append('%selse:' % indent)
+    remaining += _emit_node(rights[number], lines, depth + 1, tables)
+    return remaining
+
+def module_path(forest_path, cache_directory=MODULE_CACHE):
+    """
+    Location of the generated module for a forest file or directory, named
+    after its absolute path within the cache directory.
+    """
+    forest_path = os.path.abspath(forest_path)
+    name = '%s-%s.py' % (os.path.basename(forest_path), hashlib.sha1(forest_path).hexdigest()[:12])
+    return os.path.join(cache_directory, name)
+
+def is_stale(path, forest_path):
+    """
+    Tells whether the generated module is missing or older than the forest
+    file, or than any file of the forest directory.
+    """
+    if not os.path.exists(path):
+        return True
+
+    if os.path.isdir(forest_path):
+        forest_files = [os.path.join(forest_path, f) for f in os.listdir(forest_path)]
+
+    else:
+        forest_files = [forest_path]
+
+    return any(os.path.getmtime(path) < os.path.getmtime(f) for f in forest_files if os.path.isfile(f))
+
+def write_module(trees, path):
+    """
+    Generates the scoring module for the trees into path.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path, 'w') as module_file:
+        module_file.write(generate_source(trees))
+
+    py_compile.compile(path, doraise=True)
+    _LOG.info('scoring module for %d trees written to %s' % (len(trees), path))
+
+def load_module(path):
+    """
+    Imports a generated scoring module from the bytecode cached next to it,
+    unless the source is more recent.
+    """
+    name = '_forest_%s' % os.path.splitext(os.path.basename(path))[0].replace('-', '_').replace('.', '_')
+    compiled_path = path + ('c' if __debug__ else 'o')
+    if os.path.exists(compiled_path) and os.path.getmtime(compiled_path) >= os.path.getmtime(path):
+        return imp.load_compiled(name, compiled_path)
+
+    return imp.load_source(name, path)
+
+class GeneratedForest(object):
+
+    """
+        Forest scored by a generated module, predicting from samples given as
+        dictionaries as RandomForest.predict does.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.dimensions = module.DIMENSIONS
+
+    def predict(self, sample, use_median=False):
+        return self.module.predict([sample.get(dim) for dim in self.dimensions], use_median=use_median)
@@ -0,0 +1,579 @@
+#
+# -*- coding: utf-8 -*-
+#
+import logging
+_LOG = logging.getLogger('training')
+
+import os
+import json
+import random
+from array import array
+from collections import defaultdict
+
+import numpy
+
+from predict.decisiontree.train import BaseTrainingSet
+
+STORE_INDEX = 'index.json'
+
+def load_store(directory, mmap_mode='r'):
+    """
+    Loads a training set written by ColumnarTrainingSet.save(). By default
+    the arrays are memory-mapped, so that processes loading the same store
+    share the underlying pages.
+    """
+    with open(os.path.join(directory, STORE_INDEX), 'r') as index_file:
+        index = json.load(index_file)
+
+    if index['type'] == 'BinnedTrainingSet':
+        from predict.decisiontree.binned import BinnedTrainingSet
+        ts = BinnedTrainingSet()
+
+    else:
+        ts = ColumnarTrainingSet()
+
+    arrays = dict()
+    for key, file_name in index['arrays'].items():
+        arrays[_native(key)] = numpy.load(os.path.join(directory, file_name), mmap_mode=mmap_mode)
+
+    ts._restore(index, arrays)
+    ts.store_directory = directory
+    _LOG.info('training set: %d samples and %d dimensions mapped from %s' % (ts.count(), len(ts.get_dimensions()), directory))
+    return ts
+
+def _native(name):
+    """Column names are kept as utf-8 encoded strings, as read by the csv module."""
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+
+    return name
+
+class ColumnarTrainingSet(BaseTrainingSet):
+
+    """
+        Training set holding one contiguous float64 array per dimension,
+        undefined values being stored as NaN. Child tables only keep an
+        array of row indices into the columns of the root table.
+    """
+
+    def __init__(self):
+        super(ColumnarTrainingSet, self).__init__()
+        self._index = dict()
+        self._columns = None
+        self._buffers = None
+        self._rows = None
+        self._target_codes_column = None
+        # directory the set is mapped from, see load_store
+        self.store_directory = None
+
+    def check_column(self, column_name):
+        return column_name in self.get_dimensions()
+
+    def set_dimensions(self, dimensions):
+        self._dimensions = dimensions
+        self._buffers = list()
+        for count, dim in enumerate(dimensions):
+            self._index[dim] = count
+            self._buffers.append(array('d'))
+
+    def insert(self, item):
+        """Appends a row given as a list of values ordered as the dimensions."""
+        nan = float('nan')
+        for buf, value in zip(self._buffers, item):
+            if value is None:
+                buf.append(nan)
+
+            else:
+                buf.append(value)
+
+    def insert_columns(self, columns):
+        """Appends a block of rows given as one list of values per dimension."""
+        nan = float('nan')
+        for buf, values in zip(self._buffers, columns):
+            buf.extend([nan if value is None else value for value in values])
+
+    def _load_buffers(self):
+        """Turns the rows inserted so far into numpy columns."""
+        if self._buffers is None:
+            return
+
+        self._columns = dict()
+        for dim, buf in zip(self._dimensions, self._buffers):
+            self._columns[dim] = numpy.frombuffer(buf, dtype=numpy.float64)
+
+        self._buffers = None
+        self._rows = numpy.arange(len(self._columns[self._dimensions[0]]))
+
+    def setup_output(self, output_column_name, output_sampling):
+        self._load_buffers()
+        self._output_sampling = output_sampling
+        self._output_column = output_column_name
+        output = self._columns[output_column_name]
+        self._output_min = float(numpy.nanmin(output))
+        self._output_max = float(numpy.nanmax(output))
+        _LOG.info('output min = %s' % self._output_min)
+        _LOG.info('output max = %s' % self._output_max)
+        # binned output is computed once, undefined outputs getting an
+        # extra bin that is left out of the entropy
+        is_null = numpy.isnan(output)
+        target_codes = numpy.empty(len(output), dtype=numpy.intp)
+        target_codes[~is_null] = self._target_codes(output[~is_null])
+        target_codes[is_null] = self.target_bins()
+        self._target_codes_column = target_codes
+
+    def save(self, directory):
+        """
+        Writes the loaded data as a binary column store, one .npy file per
+        array, that load_store() maps back into memory.
+
+        @param directory: existing directory receiving the store
+        """
+        index = {
+            'type': self.__class__.__name__,
+            'dimensions': self._dimensions,
+            'output_column': self._output_column,
+            'output_sampling': self._output_sampling,
+            'output_min': self._output_min,
+            'output_max': self._output_max,
+            'binary_output': self._binary_output,
+            'arrays': dict()
+        }
+        for count, (key, values) in enumerate(sorted(self._store_arrays().items())):
+            file_name = '%d.npy' % count
+            numpy.save(os.path.join(directory, file_name), values)
+            index['arrays'][key] = file_name
+
+        with open(os.path.join(directory, STORE_INDEX), 'w') as index_file:
+            json.dump(index, index_file)
+
+    def _store_arrays(self):
+        arrays = dict()
+        for dim, values in self._columns.items():
+            arrays['column:' + dim] = values
+
+        for dim, sketch in self._sketches.items():
+            arrays['sketch:' + dim] = numpy.array(sketch, dtype=numpy.float64)
+
+        arrays['target_codes'] = self._target_codes_column
+        return arrays
+
+    def _restore(self, index, arrays):
+        self._dimensions = [_native(dim) for dim in index['dimensions']]
+        for count, dim in enumerate(self._dimensions):
+            self._index[dim] = count
+
+        self._output_column = _native(index['output_column'])
+        self._output_sampling = index['output_sampling']
+        self._output_min = index['output_min']
+        self._output_max = index['output_max']
+        self._binary_output = index['binary_output']
+        self._columns = dict()
+        for key, values in arrays.items():
+            if key.startswith('column:'):
+                self._columns[key[len('column:'):]] = values
+
+            elif key.startswith('sketch:'):
+                self._sketches[key[len('sketch:'):]] = values.tolist()
+
+        self._target_codes_column = arrays['target_codes']
+        self._rows = numpy.arange(len(self._target_codes_column))
+
+    def count(self):
+        """Counts the number of rows in the table."""
+        return len(self._rows)
+
+    def random_split(self, set_left, set_right, seed=None):
+        """
+        Randomly dispatches the rows between two tables.
+
+        @param seed: seed making the assignment reproducible, see random_sides
+        """
+        to_left = random_sides(len(self._rows), seed)
+        set_left._rows = numpy.concatenate((set_left._rows, self._rows[to_left]))
+        set_right._rows = numpy.concatenate((set_right._rows, self._rows[~to_left]))
+
+    def sample_rows(self, size, replace=False):
+        """
+        Draws rows at random, with replacement when bootstrapping. The drawn
+        rows are kept as an index array, a row drawn several times appearing
+        as many times.
+
+        @param size: number of rows to draw
+        @param replace: draws with replacement
+        @return: tuple (table of the drawn rows, positions of the rows never drawn)
+        """
+        count = self.count()
+        if replace:
+            positions = numpy.random.randint(0, count, size=size)
+
+        else:
+            positions = numpy.random.permutation(count)[:size]
+
+        draws = numpy.bincount(positions, minlength=count)
+        table = self._create_child_table(self._rows[positions])
+        self._set_uniform_ratios(table)
+        return table, numpy.flatnonzero(draws == 0).tolist()
+
+    def target_median(self):
+        """
+        Computes the median of the output
+        """
+        if self._median is None:
+            values = self._get_values_not_null(self._output_column)
+            if len(values) == 0:
+                median = None
+
+            else:
+                median = float(numpy.median(values))
+
+            self._median = median
+
+        return self._median
+
+    def target_entropy(self):
+        """
+        Computes the entropy of the output from its binned values
+        """
+        if self._entropy is None:
+            bins = self.target_bins()
+            counts = numpy.bincount(self._target_codes_column[self._rows], minlength=bins + 1)[:bins]
+            if counts.sum() == 0:
+                entropy = None
+
+            else:
+                entropy = float(histogram_entropies(counts[numpy.newaxis, :])[0])
+
+            self._entropy = entropy
+
+        return self._entropy
+
+    def split(self, dim_key, split_value):
+        """Split according to a given dimension and a split value.
+        Returns a 3-uple of tables: one for values <= split_value, one for
+        values > split_val and one for undef values of the dimension.
+
+        @param dimension: dimension to split on
+        @param split_value: split value
+
+        """
+        values = self._columns[dim_key][self._rows]
+        is_null = numpy.isnan(values)
+        with numpy.errstate(invalid='ignore'):
+            is_left = values <= split_value
+            is_right = values > split_value
+
+        left_table = self._create_child_table(self._rows[is_left])
+        right_table = self._create_child_table(self._rows[is_right])
+        null_table = self._create_child_table(self._rows[is_null])
+        self._set_split_counts(dim_key, left_table, right_table, null_table)
+        return left_table, right_table, null_table
+
+    def sweep_split(self, dim_key, candidate_values=None, seed=None):
+        """
+        Scores at once all the splits along a dimension from the rows sorted by
+        value. Rows where the dimension is undefined are randomly assigned to
+        either side once for all the thresholds, as random_split would do for
+        the same seed.
+
+        @param dim_key: dimension to split on
+        @param candidate_values: set of thresholds to be scored, all distinct values when None
+        @param seed: seed for assigning the rows where the dimension is undefined
+        @return: tuple (best value, best score)
+        """
+        values = self._columns[dim_key][self._rows]
+        codes = self._target_codes_column[self._rows]
+        is_null = numpy.isnan(values)
+        order = numpy.argsort(values[~is_null], kind='mergesort')
+        measures = values[~is_null][order]
+        if len(measures) == 0:
+            return None, None
+
+        # last position of each distinct value
+        boundaries = numpy.flatnonzero(numpy.append(measures[1:] != measures[:-1], True))
+        if candidate_values is not None:
+            # a threshold selects the last position of the highest value not above it
+            candidates = numpy.array(list(candidate_values), dtype=numpy.float64)
+            boundaries = numpy.searchsorted(measures, candidates, side='right') - 1
+            boundaries = numpy.unique(boundaries[boundaries >= 0])
+            if len(boundaries) == 0:
+                return None, None
+
+        null_codes = codes[is_null]
+        scores = partition_scores(codes[~is_null][order], boundaries + 1, null_codes,
+            random_sides(len(null_codes), seed), self.target_bins(), self.target_entropy())
+        best = numpy.argmin(scores)
+        return float(measures[boundaries[best]]), float(scores[best])
+
+    def sweep_splits(self, requests):
+        """
+        Scores the splits of several tables sharing the data of this table,
+        as sweep_split would do for each of them. Tables to be split along the
+        same dimension are processed together in one pass over the column.
+
+        @param requests: list of tuples (table, dimension, candidate values, seed)
+        @return: list of tuples (best value, best score), one per request
+        """
+        results = [(None, None)] * len(requests)
+        by_dimension = defaultdict(list)
+        for position, request in enumerate(requests):
+            by_dimension[request[1]].append(position)
+
+        for dim_key, positions in by_dimension.items():
+            batch = [requests[position] for position in positions]
+            for position, result in zip(positions, self._sweep_batch(dim_key, batch)):
+                results[position] = result
+
+        return results
+
+    def _sweep_batch(self, dim_key, batch):
+        """
+        Scores the splits along one dimension for a batch of tables, the rows
+        of all the tables being sorted at once by table and value.
+        """
+        if len(batch) == 1:
+            training_set, dim_key, candidate_values, seed = batch[0]
+            return [training_set.sweep_split(dim_key, candidate_values, seed=seed)]
+
+        bins = self.target_bins()
+        width = bins + 1
+        tables = len(batch)
+        rows = numpy.concatenate([training_set._rows for training_set, dim, values, seed in batch])
+        labels = numpy.repeat(numpy.arange(tables), [training_set.count() for training_set, dim, values, seed in batch])
+        values = self._columns[dim_key][rows]
+        codes = self._target_codes_column[rows]
+        is_null = numpy.isnan(values)
+
+        # rows where the dimension is undefined, as assigned by random_split
+        null_labels = labels[is_null]
+        null_codes = codes[is_null]
+        null_counts = numpy.bincount(null_labels, minlength=tables)
+        null_to_left = numpy.concatenate([random_sides(count, seed)
+            for count, (training_set, dim, candidate_values, seed) in zip(null_counts, batch)])
+        null_cells = null_labels * width + null_codes
+        null_left_hist = numpy.bincount(null_cells[null_to_left], minlength=tables * width).reshape((tables, width))
+        null_hist = numpy.bincount(null_cells, minlength=tables * width).reshape((tables, width))
+
+        labels = labels[~is_null]
+        order = numpy.lexsort((values[~is_null], labels))
+        measures = values[~is_null][order]
+        codes = codes[~is_null][order]
+        labels = labels[order]
+        if len(measures) == 0:
+            return [(None, None)] * tables
+
+        # last position of each distinct value within each table, restricted
+        # to the ones selected by the candidate thresholds
+        is_boundary = numpy.append((measures[1:] != measures[:-1]) | (labels[1:] != labels[:-1]), True)
+        selected = numpy.zeros(len(measures), dtype=bool)
+        for label, (training_set, dim, candidate_values, seed) in enumerate(batch):
+            start, stop = numpy.searchsorted(labels, [label, label + 1])
+            if candidate_values is None:
+                selected[start:stop] = True
+                continue
+
+            candidates = numpy.array(list(candidate_values), dtype=numpy.float64)
+            positions = start + numpy.searchsorted(measures[start:stop], candidates, side='right') - 1
+            selected[positions[positions >= start]] = True
+
+        boundaries = numpy.flatnonzero(is_boundary & selected)
+        boundary_labels = labels[boundaries]
+        if len(boundaries) == 0:
+            return [(None, None)] * tables
+
+        starts = numpy.searchsorted(labels, numpy.arange(tables))
+        left_hist = numpy.empty((len(boundaries), width), dtype=numpy.int64)
+        for code in xrange(width):
+            cumulated = numpy.append(0, numpy.cumsum(codes == code))
+            left_hist[:, code] = cumulated[boundaries + 1] - cumulated[starts[boundary_labels]]
+
+        left_hist += null_left_hist[boundary_labels]
+        total_hist = numpy.bincount(labels * width + codes, minlength=tables * width).reshape((tables, width)) + null_hist
+        right_hist = total_hist[boundary_labels] - left_hist
+        node_entropies = numpy.array([training_set.target_entropy() for training_set, dim, values, seed in batch],
+            dtype=numpy.float64)
+        scores = histogram_scores(left_hist, right_hist, bins, node_entropies[boundary_labels])
+
+        # best score per table
+        order = numpy.lexsort((scores, boundary_labels))
+        labels_found, firsts = numpy.unique(boundary_labels[order], return_index=True)
+        results = [(None, None)] * tables
+        for label, first in zip(labels_found, order[firsts]):
+            results[label] = (float(measures[boundaries[first]]), float(scores[first]))
+
+        return results
+
+    def sorted_measures(self, dim_key):
+        values = self._columns[dim_key][self._rows]
+        codes = self._target_codes_column[self._rows]
+        is_null = numpy.isnan(values)
+        order = numpy.argsort(values[~is_null], kind='mergesort')
+        measures = values[~is_null][order]
+        return measures.tolist(), self._codes_list(codes[~is_null][order]), self._codes_list(codes[is_null])
+
+    def build_sketches(self, size):
+        for dim in self._dimensions:
+            if dim == self._output_column:
+                continue
+
+            values = numpy.sort(self._sketched_values(dim))
+            if len(values) > size:
+                values = values[numpy.round(numpy.linspace(0, len(values) - 1, size)).astype(numpy.intp)]
+
+            self._sketches[dim] = numpy.unique(values).tolist()
+
+    def _sketched_values(self, dim_key):
+        """Defined values of a dimension summarized by build_sketches"""
+        return self._get_values_not_null(dim_key)
+
+    def _measure_range(self, dim_key):
+        values = self._get_values_not_null(dim_key)
+        if len(values) == 0:
+            return None, None
+
+        return float(values.min()), float(values.max())
+
+    def sample_measures(self, dim_key, sample_size):
+        """
+        Samples uniformly at random from the set of values of a dimension.
+
+        @param dimension: the dimension
+        @param sample_size: number of values to sample
+
+        """
+        sample_size = min(sample_size, self.count())
+        positions = random.sample(xrange(self.count()), sample_size)
+        values = self._columns[dim_key][self._rows[positions]]
+        return [None if value != value else value for value in values.tolist()]
+
+    def get_rows(self, positions, dimensions):
+        """
+        Input values of several rows, gathered column by column, see
+        BaseTrainingSet.get_rows
+        """
+        rows = self._rows[numpy.asarray(positions, dtype=numpy.intp)]
+        matrix = numpy.empty((len(rows), len(dimensions)), dtype=object)
+        for column, dim in enumerate(dimensions):
+            if dim is None:
+                continue
+
+            values = self._gathered_values(dim, rows)
+            matrix[:, column] = values
+            matrix[numpy.isnan(values), column] = None
+
+        return matrix.tolist()
+
+    def _gathered_values(self, dim_key, rows):
+        """Values of a dimension for an array of rows, NaN when undefined."""
+        return numpy.asarray(self._columns[dim_key][rows], dtype=numpy.float64)
+
+    def _get_measure(self, item, dim_key):
+        value = float(self._columns[dim_key][item])
+        if value != value:
+            return None
+
+        return value
+
+    def _get_items(self):
+        return self._rows
+
+    def _count_not_null(self, dim_key):
+        return len(self._get_values_not_null(dim_key))
+
+    def _get_list_not_null(self, dim):
+        """
+        Sorted list of non null values for a specific dimension.
+        """
+        if not self._list_not_null.has_key(dim):
+            self._list_not_null[dim] = numpy.sort(self._get_values_not_null(dim)).tolist()
+
+        return self._list_not_null[dim]
+
+    def _get_values_not_null(self, dim):
+        values = self._columns[dim][self._rows]
+        return values[~numpy.isnan(values)]
+
+    def _target_codes(self, values):
+        """Output bins for an array of non null output values."""
+        if self._output_min == self._output_max:
+            return numpy.zeros(len(values), dtype=numpy.intp)
+
+        alpha = (values - self._output_min) / (self._output_max - self._output_min)
+        return (alpha * (self.target_bins() - 1)).astype(numpy.intp)
+
+    def _codes_list(self, codes):
+        bins = self.target_bins()
+        return [None if code == bins else code for code in codes.tolist()]
+
+    def _create_child_table(self, rows=None):
+        ts = ColumnarTrainingSet()
+        # inheriting parent data
+        ts._dimensions = self._dimensions
+        ts._output_column = self._output_column
+        ts._output_sampling = self._output_sampling
+        ts._output_min = self._output_min
+        ts._output_max = self._output_max
+        ts._binary_output = self._binary_output
+        ts._index = self._index
+        ts._columns = self._columns
+        ts._target_codes_column = self._target_codes_column
+        ts._sketches = self._sketches
+        if rows is None:
+            rows = numpy.arange(0)
+
+        ts._rows = rows
+        return ts
+
+def histogram_entropies(histograms):
+    """Entropy of each row of a 2-d array of counts."""
+    totals = histograms.sum(axis=1).astype(numpy.float64)
+    totals[totals == 0] = 1.0
+    probabilities = histograms / totals[:, numpy.newaxis]
+    logs = numpy.log(numpy.where(probabilities > 0, probabilities, 1.0))
+    return -numpy.sum(probabilities * logs, axis=1)
+
+def random_sides(count, seed=None):
+    """
+    Random assignment of count items to the left (True) or right (False),
+    reproducible from seed.
+    """
+    return numpy.random.RandomState(seed).randint(2, size=count).astype(bool)
+
+def partition_scores(codes, left_sizes, null_codes, null_to_left, bins, node_entropy=None):
+    """
+    Scores a batch of candidate partitions of the rows of a node in a single
+    call, as the weighted entropy of the output over both sides.
+
+    @param codes: output bins of the rows, in the order used for partitioning
+    @param left_sizes: for each partition, number of leading rows going left
+    @param null_codes: output bins of the rows assigned to either side independently of the partition
+    @param null_to_left: boolean array telling which of these rows go left
+    @param bins: number of output bins, bin number bins standing for undefined outputs
+    @param node_entropy: score given to partitions leaving a side empty, scalar or one per partition
+    @return: array of scores, lower is better
+    """
+    width = bins + 1
+    null_hist = numpy.bincount(null_codes, minlength=width)
+    null_left = numpy.bincount(null_codes[null_to_left], minlength=width)
+    left_hist = numpy.empty((len(left_sizes), width), dtype=numpy.int64)
+    for code in xrange(width):
+        cumulated = numpy.cumsum(codes == code)
+        left_hist[:, code] = cumulated[left_sizes - 1] + null_left[code]
+
+    total_hist = numpy.bincount(codes, minlength=width) + null_hist
+    right_hist = total_hist - left_hist
+    return histogram_scores(left_hist, right_hist, bins, node_entropy)
+
+def histogram_scores(left_hist, right_hist, bins, node_entropy=None):
+    """
+    Weighted entropy of the output over both sides of a batch of partitions,
+    each side being given as a 2-d array of counts per output bin.
+    """
+    left_count = left_hist.sum(axis=1)
+    right_count = right_hist.sum(axis=1)
+    total = (left_count + right_count).astype(numpy.float64)
+    scores = (left_count / total) * histogram_entropies(left_hist[:, :bins]) \
+        + (right_count / total) * histogram_entropies(right_hist[:, :bins])
+    if node_entropy is not None:
+        scores = numpy.where((left_count == 0) | (right_count == 0), node_entropy, scores)
+
+    return scores
@@ -0,0 +1,309 @@
+#
+# -*- coding: utf-8 -*-
+#
+import os
+import mmap
+import logging
+import threading
+_LOG = logging.getLogger('training')
+
+import numpy
+
+from predict.decisiontree import flatten_trees
+from predict.decisiontree.forest import read_layout
+from predict.decisiontree.forest import is_binary_forest
+from predict.decisiontree.forest import load_forest
+from predict.decisiontree.forest import ANYTIME_MIN_TREES
+from predict.decisiontree.forest import MEDIAN_ERROR_RATIO
+from predict.decisiontree.tools import normal_quantile
+
+# feature index of the leaves
+LEAF = -1
+
+class CompiledForest(object):
+
+    """
+        Forest flattened into arrays indexed by node, the nodes of all the
+        trees being numbered consecutively. Samples are given as rows of a
+        matrix whose columns follow the dimensions of the forest, undefined
+        values being NaN.
+    """
+
+    def __init__(self, dimensions, roots, features, thresholds, lefts, rights, values):
+        """
+        @param dimensions: names of the split dimensions
+        @param roots: node number of each tree root
+        @param features: position of the split dimension of each node, LEAF for leaves
+        @param thresholds: split value of each node
+        @param lefts: left child of each node
+        @param rights: right child of each node
+        @param values: leaf value of each node, NaN when undefined
+        """
+        self.dimensions = list(dimensions)
+        self.roots = _as_array(roots, numpy.intp)
+        self.features = _as_array(features, numpy.intp)
+        self.thresholds = _as_array(thresholds, numpy.float64)
+        self.lefts = _as_array(lefts, numpy.intp)
+        self.rights = _as_array(rights, numpy.intp)
+        self.values = _as_array(values, numpy.float64)
+        # built when first predicting samples with undefined values, see subtree_index
+        self.missing_values = None
+        self.subtree_masks = None
+        self._index_lock = threading.Lock()
+        _LOG.info('compiled %d trees into %d nodes over %d dimensions' % (len(self.roots), len(self.features),
+            len(self.dimensions)))
+
+    @classmethod
+    def from_trees(cls, trees):
+        """
+        @param trees: root nodes of the trees, see BaseDecisionNode
+        """
+        dimensions, roots, features, thresholds, lefts, rights, values = flatten_trees(trees)
+        return cls(dimensions, roots, features,
+            [numpy.nan if value is None else value for value in thresholds],
+            lefts, rights,
+            [numpy.nan if value is None else value for value in values])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Maps the node arrays of a binary forest file, see forest.write_trees,
+        the pages being shared by the processes mapping the same file.
+        """
+        with open(path, 'rb') as forest_file:
+            data = mmap.mmap(forest_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            layout = read_layout(data)
+
+        finally:
+            data.close()
+
+        arrays = dict()
+        for name, (offset, typecode) in layout['arrays'].items():
+            arrays[name] = numpy.memmap(path, dtype=numpy.dtype(typecode).newbyteorder('<'), mode='r',
+                offset=offset, shape=(layout['nodes_count'],))
+
+        return cls(layout['dimensions'], layout['roots'], arrays['features'], arrays['thresholds'],
+            arrays['lefts'], arrays['rights'], arrays['values'])
+
+    def subtree_index(self):
+        """
+        Prediction of each subtree for samples where none of the dimensions
+        split on within the subtree is defined, along with these dimensions
+        as a packed bit mask, see predict.decisiontree.index_subtrees. The
+        masks take one bit per node and dimension, so they are only built
+        once a batch holds undefined values.
+
+        @return: tuple (missing values, subtree masks)
+        """
+        with self._index_lock:
+            if self.subtree_masks is None:
+                self._index_subtrees()
+
+        return self.missing_values, self.subtree_masks
+
+    def _index_subtrees(self):
+        """Aggregates the subtrees from the deepest level up."""
+        self.missing_values = self.values.copy()
+        self.subtree_masks = numpy.zeros((len(self.features), (len(self.dimensions) + 7) // 8), dtype=numpy.uint8)
+        # grouping the split nodes by depth, from the roots, shared nodes
+        # being found at each of their depths
+        levels = list()
+        level = numpy.unique(self.roots[self.features[self.roots] != LEAF])
+        while len(level):
+            levels.append(level)
+            children = numpy.concatenate((self.lefts[level], self.rights[level]))
+            level = numpy.unique(children[self.features[children] != LEAF])
+
+        # children being at the next level, nodes are aggregated from the deepest level up
+        for level in reversed(levels):
+            lefts = self.lefts[level]
+            rights = self.rights[level]
+            features = self.features[level]
+            self.missing_values[level] = 0.5 * (self.missing_values[lefts] + self.missing_values[rights])
+            masks = self.subtree_masks[lefts] | self.subtree_masks[rights]
+            masks[numpy.arange(len(level)), features // 8] |= (1 << (7 - features % 8)).astype(numpy.uint8)
+            self.subtree_masks[level] = masks
+
+    def trees_count(self):
+        return len(self.roots)
+
+    def predict_trees(self, matrix, roots=None):
+        """
+        Predictions of each tree for a block of samples, routed through the
+        trees one level at a time. A sample whose split dimension is
+        undefined goes down both branches with half of its weight, which
+        averages both subtrees as BaseDecisionNode.predict does, unless none
+        of the dimensions of the subtree is defined.
+
+        @param matrix: 2-d float array, one row per sample and one column per dimension
+        @param roots: root nodes of the trees to evaluate, all the trees by default
+        @return: 2-d float array (samples, trees), NaN where a tree has no prediction
+        """
+        if roots is None:
+            roots = self.roots
+
+        samples_count = matrix.shape[0]
+        trees_count = len(roots)
+        defined_masks = None
+        # each entry is a sample being routed through one tree
+        slots = numpy.arange(samples_count * trees_count)
+        nodes = numpy.tile(roots, samples_count)
+        weights = numpy.ones(len(slots))
+        sums = numpy.zeros(samples_count * trees_count)
+        while len(slots):
+            features = self.features[nodes]
+            is_leaf = features == LEAF
+            if is_leaf.any():
+                sums += numpy.bincount(slots[is_leaf], weights=weights[is_leaf] * self.values[nodes[is_leaf]],
+                    minlength=len(sums))
+                slots = slots[~is_leaf]
+                nodes = nodes[~is_leaf]
+                weights = weights[~is_leaf]
+                features = features[~is_leaf]
+
+            measures = matrix[slots // trees_count, features]
+            is_null = numpy.isnan(measures)
+            with numpy.errstate(invalid='ignore'):
+                is_left = measures <= self.thresholds[nodes]
+
+            next_nodes = numpy.where(is_left, self.lefts[nodes], self.rights[nodes])
+            if is_null.any():
+                # subtrees without any defined dimension are predicted at once
+                if defined_masks is None:
+                    defined_masks = numpy.packbits(~numpy.isnan(matrix), axis=1)
+                    missing_values, subtree_masks = self.subtree_index()
+
+                null_nodes = nodes[is_null]
+                is_resolved = numpy.zeros(len(nodes), dtype=bool)
+                is_resolved[is_null] = ~(subtree_masks[null_nodes]
+                    & defined_masks[slots[is_null] // trees_count]).any(axis=1)
+                if is_resolved.any():
+                    sums += numpy.bincount(slots[is_resolved],
+                        weights=weights[is_resolved] * missing_values[nodes[is_resolved]], minlength=len(sums))
+                    slots = slots[~is_resolved]
+                    nodes = nodes[~is_resolved]
+                    weights = weights[~is_resolved]
+                    is_null = is_null[~is_resolved]
+                    next_nodes = next_nodes[~is_resolved]
+
+            if is_null.any():
+                weights = weights.copy()
+                weights[is_null] *= 0.5
+                slots = numpy.concatenate((slots, slots[is_null]))
+                # undefined measures compare as right, the copies going left
+                next_nodes = numpy.concatenate((next_nodes, self.lefts[nodes[is_null]]))
+                weights = numpy.concatenate((weights, weights[is_null]))
+
+            nodes = next_nodes
+
+        return sums.reshape((samples_count, trees_count))
+
+    def predict_batch(self, matrix, use_median=False, tolerance=None, confidence=0.95, max_trees=None):
+        """
+        Predicts the regressand for a block of samples, as RandomForest.predict
+        does for each of them. Given a tolerance, trees are evaluated by
+        groups of ANYTIME_MIN_TREES, only for the samples whose output is not
+        yet stable.
+
+        @param matrix: 2-d float array, one row per sample and one column per dimension
+        @param use_median: aggregates the trees output using the median rather than the mean
+        @param tolerance: maximum half-width of the confidence interval of the output, None for using all the trees
+        @param confidence: confidence level of the interval
+        @param max_trees: maximum number of trees evaluated, None for no limit
+        @return: float array, NaN for the samples no tree was able to predict
+        """
+        roots = self.roots
+        if max_trees is not None:
+            roots = roots[:max_trees]
+
+        if tolerance is None:
+            predictions = self.predict_trees(matrix, roots)
+
+        else:
+            predictions = self._predict_anytime(matrix, roots, use_median, tolerance, confidence)
+
+        is_defined = ~numpy.isnan(predictions)
+        counts = is_defined.sum(axis=1)
+        if (counts == 0).any():
+            _LOG.warn('no tree was able to predict an output for %d samples' % (counts == 0).sum())
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            if use_median:
+                ordered = numpy.sort(predictions, axis=1)
+                rows = numpy.arange(len(ordered))
+                upper = ordered[rows, numpy.maximum(counts, 1) // 2]
+                lower = ordered[rows, numpy.maximum(counts - 1, 0) // 2]
+                output = 0.5 * (lower + upper)
+                output[counts == 0] = numpy.nan
+
+            else:
+                output = numpy.where(is_defined, predictions, 0.0).sum(axis=1) / counts
+
+        return output
+
+    def _predict_anytime(self, matrix, roots, use_median, tolerance, confidence):
+        """
+        Predictions of the trees evaluated for each sample, NaN for the trees
+        skipped once the output of the sample was stable.
+        """
+        z = normal_quantile(0.5 + 0.5 * confidence)
+        if use_median:
+            z *= MEDIAN_ERROR_RATIO
+
+        predictions = numpy.empty((matrix.shape[0], len(roots)))
+        predictions.fill(numpy.nan)
+        active = numpy.arange(matrix.shape[0])
+        for start in xrange(0, len(roots), ANYTIME_MIN_TREES):
+            end = min(start + ANYTIME_MIN_TREES, len(roots))
+            predictions[active, start:end] = self.predict_trees(matrix[active], roots[start:end])
+            evaluated = predictions[active, :end]
+            is_defined = ~numpy.isnan(evaluated)
+            counts = is_defined.sum(axis=1)
+            values = numpy.where(is_defined, evaluated, 0.0)
+            totals = values.sum(axis=1)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                variances = numpy.maximum((values * values).sum(axis=1) - totals * totals / counts, 0.0) / (counts - 1)
+                is_stable = (counts >= max(ANYTIME_MIN_TREES, 2)) & (z * numpy.sqrt(variances / counts) <= tolerance)
+
+            active = active[~is_stable]
+            if not len(active):
+                break
+
+        _LOG.debug('%d samples out of %d evaluated by all the trees' % (len(active), matrix.shape[0]))
+        return predictions
+
+    def matrix(self, samples):
+        """
+        Converts samples given as dictionaries into a matrix for predict_batch,
+        missing or None values being undefined.
+        """
+        matrix = numpy.empty((len(samples), len(self.dimensions)))
+        matrix.fill(numpy.nan)
+        for row, sample in enumerate(samples):
+            for column, dim in enumerate(self.dimensions):
+                value = sample.get(dim)
+                if value is not None:
+                    matrix[row, column] = value
+
+        return matrix
+
+def load_compiled(path, threads=4):
+    """
+    Maps a binary forest file as it is, other forests being loaded from
+    their files and compiled.
+
+    @param threads: number of forest files read concurrently
+    """
+    if os.path.isfile(path) and is_binary_forest(path):
+        return CompiledForest.load(path)
+
+    return load_forest(path, threads=threads).compile()
+
+def _as_array(values, dtype):
+    """Arrays, possibly memory-mapped, are used as they are."""
+    if isinstance(values, numpy.ndarray):
+        return values
+
+    return numpy.array(values, dtype=dtype)
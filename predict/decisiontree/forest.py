@@ -2,32 +2,258 @@
 # -*- coding: utf-8 -*-
 #
 
+import os
+import sys
+import math
+import mmap
+import struct
 import logging
+from array import array
+from collections import deque
 from predict.decisiontree import DecisionTreeFactory
 from predict.decisiontree import LeafDecisionNode
 from predict.decisiontree import DecisionNode
+from predict.decisiontree import index_subtrees
+from predict.decisiontree import row_mask
+from predict.decisiontree import positioned_dimensions
+from predict.decisiontree import flatten_trees
+from predict.decisiontree import build_trees
+from predict.decisiontree import share_subtrees
+from predict.decisiontree.tools import normal_quantile
+from predict.decisiontree.tools import mean_interval
 from train import TrainingSet
 
 _LOG = logging.getLogger('training')
 
-def serialize_forests(forests, output):
-    import cPickle
+# binary forest format: header, dimension names, root node of each tree
+# and node arrays aligned on 8 bytes, all little-endian. Nodes may be shared
+# by several parents and trees. Version 1 stored (first node, nodes count)
+# for each tree.
+FOREST_MAGIC = 'DTLF'
+FOREST_VERSION = 2
+_HEADER = struct.Struct('<4sHHIII')
+_NAME_SIZE = struct.Struct('<H')
+_TREE_RANGE = struct.Struct('<II')
+_TREE_ROOT = struct.Struct('<I')
+# node arrays as (name, array typecode, item size), in file order
+_NODE_ARRAYS = (
+    ('thresholds', 'd', 8),
+    ('values', 'd', 8),
+    ('features', 'i', 4),
+    ('lefts', 'i', 4),
+    ('rights', 'i', 4)
+    )
+
+# anytime prediction: number of tree predictions before testing for stability
+ANYTIME_MIN_TREES = 8
+# standard error of the median relative to the one of the mean, for normal values
+MEDIAN_ERROR_RATIO = math.sqrt(math.pi / 2.0)
+
+# python modules left in forest directories by earlier code generation
+_MODULE_EXTENSIONS = ('.py', '.pyc', '.pyo')
+
+def serialize_forests(forests, output, shared=False):
+    """
+    @param shared: merges the identical subtrees of all the forests before writing, see share_subtrees
+    """
     trees = list()
     for forest in forests:
         trees += forest.trees
         
-    cPickle.dump(trees, output)
+    if shared:
+        trees = share_subtrees(trees)
+        
+    write_trees(trees, output)
+
+def write_trees(trees, output):
+    """
+    Writes trees in the binary forest format, subtrees shared by several
+    parents being written once.
+
+    @param output: file opened for writing in binary mode
+    """
+    dimensions, roots, features, thresholds, lefts, rights, values = flatten_trees(trees)
+    nan = float('nan')
+    arrays = {
+        'thresholds': [nan if value is None else value for value in thresholds],
+        'values': [nan if value is None else value for value in values],
+        'features': features,
+        'lefts': lefts,
+        'rights': rights
+    }
+    chunks = [_HEADER.pack(FOREST_MAGIC, FOREST_VERSION, 0, len(dimensions), len(roots), len(features))]
+    for dim in dimensions:
+        if isinstance(dim, unicode):
+            dim = dim.encode('utf-8')
+            
+        chunks.append(_NAME_SIZE.pack(len(dim)) + dim)
+        
+    for root in roots:
+        chunks.append(_TREE_ROOT.pack(root))
+        
+    header = ''.join(chunks)
+    output.write(header + '\0' * (-len(header) % 8))
+    for name, typecode, size in _NODE_ARRAYS:
+        values = array(typecode, arrays[name])
+        if sys.byteorder == 'big':
+            values.byteswap()
+            
+        output.write(values.tostring())
+
+def read_layout(data):
+    """
+    Decodes the header of a binary forest.
+
+    @param data: string or memory map holding at least the header
+    @return: dictionary with dimensions (list of names), roots (root node of each tree),
+        nodes_count, and arrays giving the (offset, typecode) of each node array
+    """
+    magic, version, flags, dimensions_count, trees_count, nodes_count = _HEADER.unpack_from(data, 0)
+    if magic != FOREST_MAGIC:
+        raise ValueError('not a binary forest')
+        
+    if version not in (1, FOREST_VERSION):
+        raise ValueError('unsupported binary forest version %d' % version)
+        
+    offset = _HEADER.size
+    dimensions = list()
+    for count in xrange(dimensions_count):
+        size, = _NAME_SIZE.unpack_from(data, offset)
+        offset += _NAME_SIZE.size
+        dimensions.append(data[offset:offset + size])
+        offset += size
+        
+    roots = list()
+    for count in xrange(trees_count):
+        if version == 1:
+            first, tree_size = _TREE_RANGE.unpack_from(data, offset)
+            roots.append(first)
+            offset += _TREE_RANGE.size
+            
+        else:
+            roots.append(_TREE_ROOT.unpack_from(data, offset)[0])
+            offset += _TREE_ROOT.size
+        
+    offset += -offset % 8
+    arrays = dict()
+    for name, typecode, size in _NODE_ARRAYS:
+        arrays[name] = (offset, typecode)
+        offset += nodes_count * size
+        
+    return {
+        'dimensions': dimensions,
+        'roots': roots,
+        'nodes_count': nodes_count,
+        'arrays': arrays
+    }
+
+def is_binary_forest(path):
+    with open(path, 'rb') as forest_file:
+        return forest_file.read(len(FOREST_MAGIC)) == FOREST_MAGIC
+
+def load_trees(path):
+    """
+    Loads the trees of a forest file, either in the binary forest format or
+    as a pickled list of trees.
+    """
+    if not is_binary_forest(path):
+        import cPickle
+        with open(path, 'rb') as forest_file:
+            return cPickle.load(forest_file)
+            
+    with open(path, 'rb') as forest_file:
+        data = mmap.mmap(forest_file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+    try:
+        layout = read_layout(data)
+        nodes_count = layout['nodes_count']
+        arrays = dict()
+        for name, typecode, size in _NODE_ARRAYS:
+            offset = layout['arrays'][name][0]
+            arrays[name] = array(typecode, data[offset:offset + nodes_count * size])
+            if sys.byteorder == 'big':
+                arrays[name].byteswap()
+                
+    finally:
+        data.close()
+        
+    values = [None if value != value else value for value in arrays['values']]
+    return build_trees(layout['dimensions'], layout['roots'], arrays['features'], arrays['thresholds'],
+        arrays['lefts'], arrays['rights'], values)
+
+def forest_files(path):
+    """Files of a forest, given as a file or as a directory of files."""
+    if os.path.isdir(path):
+        return [os.path.join(path, f) for f in sorted(os.listdir(path))
+            if os.path.isfile(os.path.join(path, f)) and not f.endswith(_MODULE_EXTENSIONS)]
+            
+    return [path]
+    
+def iter_trees(path, threads=4):
+    """
+    Iterates over the trees of a forest file or directory. Files are read
+    ahead by a pool of threads, at most one pending file per thread, and
+    their trees are yielded in file order as soon as each file is loaded.
+
+    @param threads: number of files read concurrently
+    """
+    files = forest_files(path)
+    threads = min(threads, len(files))
+    if threads <= 1:
+        for forest_file in files:
+            for tree in load_trees(forest_file):
+                yield tree
+                
+        return
+        
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(processes=threads)
+    pending = deque()
+    try:
+        for forest_file in files:
+            if len(pending) == threads:
+                for tree in pending.popleft().get():
+                    yield tree
+                    
+            pending.append(pool.apply_async(load_trees, (forest_file,)))
+            
+        while pending:
+            for tree in pending.popleft().get():
+                yield tree
+                
+    finally:
+        pool.terminate()
+        pool.join()
+        
+def load_forest(path, threads=4):
+    """
+    Loads a forest from a file or from all the files of a directory.
+
+    @param threads: number of files read concurrently
+    """
+    forest = RandomForest()
+    forest.use_trees(list(iter_trees(path, threads=threads)))
+    _LOG.info('loaded a total of %d trees' % len(forest.trees))
+    return forest
 
 class RandomForest(object):
     """Random Forest built from bagging regression trees."""
 
     def __init__(self):
         self.trees = []
+        # number of trees prepared for predicting sample rows, see index_subtrees
+        self._indexed_trees = 0
+        # bit mask of the positions of the split dimensions in the sample rows
+        self._dimensions_mask = 0
+        self._dimensions = list()
 
     def set_training_data(self, table, target, inclusion_ratio=.1,
                  exclude=[], min_count=None, min_gain=0.0,
                  split_sampling=50,
-                 dimension_significance_threshold=0.5
+                 dimension_significance_threshold=0.5,
+                 split_workers=None,
+                 bootstrap=False,
+                 subsample=1.0
                  ):
         """
         Prepares forest for the training phase.
@@ -38,10 +264,18 @@ class RandomForest(object):
         @param exclude: list of attributes to exclude from learning
         @param min_count: threshold for leaf size
         @param min_gain: minimum gain in entropy for splitting
-        @param split_sampling: number of values to sample when considering a new split on an attribute
+        @param split_sampling: number of values to sample when considering a new split on an attribute, 0 for all values
+        @param dimension_significance_threshold: minimum ratio of defined values for an attribute to be considered at a node
+        @param split_workers: number of processes assessing the attributes of a node in parallel
+        @param bootstrap: grows each tree from rows drawn with replacement
+        @param subsample: fraction of the rows drawn for growing each tree, within ]0, 1]
 
         """
         assert table.check_column(target), 'target column "%s" is missing in input dataset' % target
+        if not 0.0 < subsample <= 1.0:
+            # split workers share the row positions of a tree in arrays sized after the training set
+            raise ValueError('subsample must be within ]0, 1], got %s' % subsample)
+
         _LOG.debug('building forest using new training data')
         self.table = table
         table_size = table.count()
@@ -57,8 +291,14 @@ class RandomForest(object):
         self.min_gain = min_gain
         self.split_sampling = split_sampling
         self.dimension_significance_threshold = dimension_significance_threshold
+        self.split_workers = split_workers
+        self.bootstrap = bootstrap
+        self.subsample = subsample
         self.target = target
         self._tree_factory = None
+        # out-of-bag predictions accumulated per row of the training set
+        self._oob_sums = None
+        self._oob_counts = None
 
     @property
     def tree_factory(self):
@@ -69,35 +309,183 @@ class RandomForest(object):
                 self.min_count,
                 self.min_gain,
                 self.split_sampling,
-                self.dimension_significance_threshold
+                self.dimension_significance_threshold,
+                split_workers=self.split_workers
                 )
         
         return self._tree_factory
 
     def grow_tree(self):
-        """Grow a single tree."""
+        """
+        Grow a single tree. When bagging, the rows left out of the tree are
+        predicted right away for estimating the generalization error.
+        """
         _LOG.info('growing a new tree')
-        tree = self.tree_factory.create()
+        if self.bootstrap or self.subsample < 1.0:
+            size = max(int(round(self.subsample * self.table.count())), 1)
+            sample, out_of_bag = self.table.sample_rows(size, replace=self.bootstrap)
+            _LOG.info('training on %d rows, %d rows out of bag' % (sample.count(), len(out_of_bag)))
+            tree = self.tree_factory.create(sample)
+            del sample
+            # rows only hold the split dimensions of the tree, predicted without building samples
+            rows = self.table.get_rows(out_of_bag, positioned_dimensions(index_subtrees(tree)))
+            predictions = [tree.predict_row(row, row_mask(row)) for row in rows]
+            self.add_out_of_bag(out_of_bag, predictions)
+            
+        else:
+            tree = self.tree_factory.create()
+            
         self.trees.append(tree)
         return tree
             
+    def add_out_of_bag(self, positions, predictions):
+        """
+        Accumulates predictions for rows of the training set.
+
+        @param positions: positions of the rows in the training set
+        @param predictions: predicted values, in the same order
+        """
+        if self._oob_sums is None:
+            self._oob_sums = [0.0] * self.table.count()
+            self._oob_counts = [0] * self.table.count()
+            
+        for position, prediction in zip(positions, predictions):
+            if prediction is not None:
+                self._oob_sums[position] += prediction
+                self._oob_counts[position] += 1
+                
+    def out_of_bag_predictions(self):
+        """
+        Mean out-of-bag prediction for each row predicted at least once.
+
+        @return: tuple (list of positions, list of predictions)
+        """
+        positions = list()
+        predictions = list()
+        if self._oob_sums is not None:
+            for position, count in enumerate(self._oob_counts):
+                if count:
+                    positions.append(position)
+                    predictions.append(self._oob_sums[position] / count)
+                    
+        return positions, predictions
+        
+    def out_of_bag_error(self):
+        """
+        Mean absolute error of the out-of-bag predictions.
+
+        @return: tuple (error, number of rows predicted), error being None when no row was left out
+        """
+        positions, predictions = self.out_of_bag_predictions()
+        error = 0.0
+        samples_count = 0
+        for position, prediction in zip(positions, predictions):
+            target = self.table.get_target(position)
+            if target is not None:
+                error += abs(target - prediction)
+                samples_count += 1
+                
+        if samples_count == 0:
+            return None, 0
+            
+        return error / samples_count, samples_count
+            
     def grow_trees(self, trees_count):
         """Grow a given number of trees."""
         for i in range(trees_count):
             tree = self.grow_tree()
+            
+        self.tree_factory.close()
 
     def use_trees(self, trees):
         self.trees += trees
 
-    def predict(self, sample, use_median=False):
+    def share_subtrees(self):
+        """
+        Merges the identical subtrees of the forest, see share_subtrees
         """
-        Predicts the regressand for a new sample
+        self.trees = share_subtrees(self.trees)
+        
+    def compile(self):
         """
+        Flattens the trees into arrays for predicting blocks of samples at
+        once, see compiled.CompiledForest.predict_batch
+        """
+        from predict.decisiontree.compiled import CompiledForest
+        return CompiledForest.from_trees(self.trees)
+
+    def index_trees(self):
+        """
+        Prepares the trees added since the last call for predicting sample
+        rows, see index_subtrees
+        """
+        if self._indexed_trees == len(self.trees):
+            return
+            
+        for tree in self.trees[self._indexed_trees:]:
+            self._dimensions_mask |= index_subtrees(tree)
+            
+        self._indexed_trees = len(self.trees)
+        self._dimensions = positioned_dimensions(self._dimensions_mask)
+        
+    @property
+    def dimensions(self):
+        """
+        Split dimensions of the forest, ordered by their position in the
+        sample rows, None for the positions of dimensions only split on by
+        other forests, see dimension_position
+        """
+        self.index_trees()
+        return self._dimensions
+        
+    def row(self, sample):
+        """Converts a sample given as a dictionary into a row, see dimensions"""
+        return [sample.get(dim) for dim in self.dimensions]
+        
+    def predict(self, sample, use_median=False, tolerance=None, confidence=0.95, max_trees=None):
+        """
+        Predicts the regressand for a new sample, given either as a dictionary
+        or as a row of values ordered as dimensions, None for undefined
+        values. Trees are evaluated in their order; given a tolerance,
+        evaluation stops as soon as the half-width of the confidence interval
+        of the output gets within the tolerance.
+
+        @param use_median: aggregates the trees output using the median rather than the mean
+        @param tolerance: maximum half-width of the confidence interval of the output, None for using all the trees
+        @param confidence: confidence level of the interval
+        @param max_trees: maximum number of trees evaluated, None for no limit
+        """
+        if isinstance(sample, dict):
+            row = self.row(sample)
+            
+        else:
+            row = sample
+            
+        self.index_trees()
+        mask = row_mask(row)
+        trees = self.trees
+        if max_trees is not None:
+            trees = trees[:max_trees]
+            
+        if tolerance is not None:
+            z = normal_quantile(0.5 + 0.5 * confidence)
+            if use_median:
+                z *= MEDIAN_ERROR_RATIO
+                
+            total = 0.0
+            total_squares = 0.0
+            
         predictions = list()
-        for tree in self.trees:
-            prediction = tree.predict(sample)
+        for tree in trees:
+            prediction = tree.predict_row(row, mask)
             if prediction is not None:
                 predictions.append(prediction)
+                if tolerance is not None:
+                    total += prediction
+                    total_squares += prediction * prediction
+                    if len(predictions) >= ANYTIME_MIN_TREES and \
+                            mean_interval(len(predictions), total, total_squares, z) <= tolerance:
+                        break
 
         if len(predictions) == 0:
             _LOG.warn('no tree was able to predict an output for sample: %s' % sample)
@@ -116,10 +504,9 @@ class RandomForest(object):
             return median
         
         if use_median:
-            output = median(predictions)
+            output = median(sorted(predictions))
             
         else:
             output = float(sum(predictions)) / len(predictions)
         
         return output
-
@@ -98,6 +98,9 @@ class NDBTrainingSet(BaseTrainingSet):
         dimension = self._get_dimension_from_key(dim_key)
         return dimension.measures[item].value
 
+    def _get_target(self, item):
+        return self._output_column.measures[item].value
+
     def _get_dimension_from_key(self, dim_key):
         if not self._dimensions_by_key.has_key(dim_key):
             self._dimensions_by_key[dim_key] = dim_key.get()
@@ -0,0 +1,510 @@
+#
+# -*- coding: utf-8 -*-
+#
+import logging
+_LOG = logging.getLogger('training')
+
+import os
+import shutil
+import tempfile
+import itertools
+
+import numpy
+
+from predict.decisiontree.columnar import ColumnarTrainingSet
+from predict.decisiontree.columnar import histogram_entropies
+from predict.decisiontree.columnar import histogram_scores
+
+# estimated memory used per row of a node loaded in memory: row id, gathered
+# value and output bin, along with the temporary arrays of a split search
+ROW_BYTES = 48
+# rows read at once when scanning a node kept on disk
+CHUNK_ROWS = 1 << 20
+# bins of the histograms narrowing down the median of a node kept on disk
+MEDIAN_BINS = 4096
+# rows sampled for the quantile sketches of a training set kept on disk
+SKETCH_SAMPLE_ROWS = 1 << 22
+
+class ChunkedTrainingSet(ColumnarTrainingSet):
+
+    """
+        Training set for data larger than memory. Columns are appended to
+        files while loading and memory-mapped, and the row ids of the tables
+        holding more rows than the memory budget are kept in files as well.
+        Such tables are scanned by chunks of rows, splits being scored from
+        per-candidate histograms of the output. Tables within the budget are
+        handled in memory as by ColumnarTrainingSet, their columns staying
+        mapped from disk.
+    """
+
+    def __init__(self, memory_budget=1 << 30, directory=None):
+        """
+        @param memory_budget: size in bytes above which the rows of a table are kept on disk
+        @param directory: location of the working files, removed along with the last table using them
+        """
+        super(ChunkedTrainingSet, self).__init__()
+        self._memory_rows = max(memory_budget // ROW_BYTES, 1)
+        self._chunk_rows = min(CHUNK_ROWS, self._memory_rows)
+        self._workspace = None
+        self._directory = directory
+        self._row_dtype = numpy.int64
+        # file holding the row ids, None when they are kept in memory
+        self._row_file = None
+        self._sketch_rows = None
+
+    def set_dimensions(self, dimensions):
+        self._dimensions = dimensions
+        self._workspace = _Workspace(self._directory)
+        self._buffers = list()
+        for count, dim in enumerate(dimensions):
+            self._index[dim] = count
+            self._buffers.append(open(self._workspace.new_path('column'), 'wb'))
+
+        self._inserted = 0
+
+    def insert(self, item):
+        """Appends a row given as a list of values ordered as the dimensions."""
+        self.insert_columns([[value] for value in item])
+
+    def insert_columns(self, columns):
+        """Appends a block of rows given as one list of values per dimension."""
+        for column_file, values in zip(self._buffers, columns):
+            # None is converted to NaN
+            numpy.array(values, dtype=numpy.float64).tofile(column_file)
+
+        self._inserted += len(columns[0])
+
+    def _load_buffers(self):
+        """Maps the columns written so far, all the rows making the table."""
+        if self._buffers is None:
+            return
+
+        self._columns = dict()
+        for dim, column_file in zip(self._dimensions, self._buffers):
+            column_file.close()
+            if self._inserted:
+                self._columns[dim] = numpy.memmap(column_file.name, dtype=numpy.float64, mode='r',
+                    shape=(self._inserted,))
+
+            else:
+                self._columns[dim] = numpy.zeros(0)
+
+        self._buffers = None
+        if self._inserted < 1 << 32:
+            self._row_dtype = numpy.uint32
+
+        writer = self._row_writer()
+        for start in xrange(0, self._inserted, self._chunk_rows):
+            writer.append(numpy.arange(start, min(start + self._chunk_rows, self._inserted), dtype=self._row_dtype))
+
+        self._rows, self._row_file = writer.close()
+
+    def setup_output(self, output_column_name, output_sampling):
+        self._load_buffers()
+        self._output_sampling = output_sampling
+        self._output_column = output_column_name
+        output = self._columns[output_column_name]
+        lowest = None
+        highest = None
+        for start in xrange(0, len(output), self._chunk_rows):
+            values = numpy.asarray(output[start:start + self._chunk_rows])
+            values = values[~numpy.isnan(values)]
+            if len(values):
+                lowest = float(values.min()) if lowest is None else min(lowest, float(values.min()))
+                highest = float(values.max()) if highest is None else max(highest, float(values.max()))
+
+        self._output_min = lowest
+        self._output_max = highest
+        _LOG.info('output min = %s' % self._output_min)
+        _LOG.info('output max = %s' % self._output_max)
+        # binned output is written once, undefined outputs getting an extra bin
+        target_codes = numpy.memmap(self._workspace.new_path('codes'), dtype=numpy.intp, mode='w+',
+            shape=(max(len(output), 1),))[:len(output)]
+        for start in xrange(0, len(output), self._chunk_rows):
+            values = numpy.asarray(output[start:start + self._chunk_rows])
+            is_null = numpy.isnan(values)
+            codes = numpy.empty(len(values), dtype=numpy.intp)
+            codes[~is_null] = self._target_codes(values[~is_null])
+            codes[is_null] = self.target_bins()
+            target_codes[start:start + len(values)] = codes
+
+        self._target_codes_column = target_codes
+
+    def is_on_disk(self):
+        """Tells whether the row ids of the table are kept on disk"""
+        return self._row_file is not None
+
+    def target_median(self):
+        """
+        Computes the median of the output, by narrowing down histograms of the
+        output when the table is kept on disk
+        """
+        if not self.is_on_disk():
+            return super(ChunkedTrainingSet, self).target_median()
+
+        if self._median is None:
+            count = sum(len(values) for values in self._target_chunks())
+            if count == 0:
+                self._median = None
+
+            elif count & 1:
+                self._median = self._order_statistic(count / 2)
+
+            else:
+                self._median = 0.5 * (self._order_statistic(count / 2 - 1) + self._order_statistic(count / 2))
+
+        return self._median
+
+    def _order_statistic(self, rank):
+        """
+        Value of the given rank among the defined outputs of the table,
+        narrowing down the range holding it until the values within the range
+        fit in memory.
+        """
+        lowest = self._output_min
+        highest = self._output_max
+        while True:
+            if lowest == highest:
+                return float(lowest)
+
+            edges = numpy.linspace(lowest, highest, MEDIAN_BINS + 1)
+            if numpy.any(edges[1:] == edges[:-1]):
+                # range too narrow to be split further
+                counts = None
+
+            else:
+                counts = numpy.zeros(MEDIAN_BINS, dtype=numpy.int64)
+                for values in self._target_chunks():
+                    values = values[(values >= lowest) & (values <= highest)]
+                    bins = numpy.minimum(numpy.searchsorted(edges, values, side='right') - 1, MEDIAN_BINS - 1)
+                    counts += numpy.bincount(bins, minlength=MEDIAN_BINS)
+
+            if counts is None or counts.sum() <= self._memory_rows:
+                values = numpy.concatenate([values[(values >= lowest) & (values <= highest)]
+                    for values in self._target_chunks()])
+                return float(numpy.partition(values, rank)[rank])
+
+            cumulated = numpy.cumsum(counts)
+            found = numpy.searchsorted(cumulated, rank, side='right')
+            if found:
+                rank -= cumulated[found - 1]
+
+            # the last bin holds its upper edge
+            lowest = edges[found]
+            highest = edges[found + 1]
+            if found < MEDIAN_BINS - 1:
+                highest = numpy.nextafter(highest, -numpy.inf)
+
+    def target_entropy(self):
+        if not self.is_on_disk():
+            return super(ChunkedTrainingSet, self).target_entropy()
+
+        if self._entropy is None:
+            bins = self.target_bins()
+            counts = numpy.zeros(bins + 1, dtype=numpy.int64)
+            for rows in self._chunks():
+                counts += numpy.bincount(self._target_codes_column[rows], minlength=bins + 1)
+
+            counts = counts[:bins]
+            if counts.sum() == 0:
+                self._entropy = None
+
+            else:
+                self._entropy = float(histogram_entropies(counts[numpy.newaxis, :])[0])
+
+        return self._entropy
+
+    def split(self, dim_key, split_value):
+        if not self.is_on_disk():
+            return super(ChunkedTrainingSet, self).split(dim_key, split_value)
+
+        left_rows = self._row_writer()
+        right_rows = self._row_writer()
+        null_rows = self._row_writer()
+        column = self._columns[dim_key]
+        for rows in self._chunks():
+            values = column[rows]
+            with numpy.errstate(invalid='ignore'):
+                left_rows.append(rows[values <= split_value])
+                right_rows.append(rows[values > split_value])
+
+            null_rows.append(rows[numpy.isnan(values)])
+
+        left_table = self._create_child_table(*left_rows.close())
+        right_table = self._create_child_table(*right_rows.close())
+        null_table = self._create_child_table(*null_rows.close())
+        self._set_split_counts(dim_key, left_table, right_table, null_table)
+        return left_table, right_table, null_table
+
+    def random_split(self, set_left, set_right, seed=None):
+        """
+        Randomly dispatches the rows between two tables, drawing the sides as
+        random_sides does for the same seed.
+        """
+        if not (self.is_on_disk() or set_left.is_on_disk() or set_right.is_on_disk()) \
+                and self.count() + set_left.count() + set_right.count() <= self._memory_rows:
+            return super(ChunkedTrainingSet, self).random_split(set_left, set_right, seed=seed)
+
+        left_rows = self._row_writer()
+        right_rows = self._row_writer()
+        for rows in set_left._chunks():
+            left_rows.append(rows)
+
+        for rows in set_right._chunks():
+            right_rows.append(rows)
+
+        # drawing the sides by chunks gives the same sequence as drawing them at once
+        sides = numpy.random.RandomState(seed)
+        for rows in self._chunks():
+            to_left = sides.randint(2, size=len(rows)).astype(bool)
+            left_rows.append(rows[to_left])
+            right_rows.append(rows[~to_left])
+
+        set_left._rows, set_left._row_file = left_rows.close()
+        set_right._rows, set_right._row_file = right_rows.close()
+
+    def sweep_split(self, dim_key, candidate_values=None, seed=None):
+        """
+        Scores the splits along a dimension as ColumnarTrainingSet.sweep_split
+        does. Tables kept on disk accumulate histograms of the output between
+        consecutive candidates, every quantile of the sketch being a candidate
+        when none is given.
+        """
+        if not self.is_on_disk():
+            return super(ChunkedTrainingSet, self).sweep_split(dim_key, candidate_values, seed=seed)
+
+        if candidate_values is None:
+            candidate_values = self._sketches.get(dim_key) or self.candidate_values(dim_key, SKETCH_SAMPLE_ROWS)
+
+        candidates = numpy.unique(numpy.array(list(candidate_values), dtype=numpy.float64))
+        if len(candidates) == 0:
+            return None, None
+
+        bins = self.target_bins()
+        width = bins + 1
+        # rows with cands[i - 1] < value <= cands[i] fall into slot i
+        slots = len(candidates) + 1
+        histograms = numpy.zeros((slots, width), dtype=numpy.int64)
+        highest_values = numpy.empty(slots)
+        highest_values.fill(-numpy.inf)
+        null_hist = numpy.zeros(width, dtype=numpy.int64)
+        null_left = numpy.zeros(width, dtype=numpy.int64)
+        sides = numpy.random.RandomState(seed)
+        column = self._columns[dim_key]
+        for rows in self._chunks():
+            values = column[rows]
+            codes = self._target_codes_column[rows]
+            is_null = numpy.isnan(values)
+            null_codes = codes[is_null]
+            to_left = sides.randint(2, size=len(null_codes)).astype(bool)
+            null_hist += numpy.bincount(null_codes, minlength=width)
+            null_left += numpy.bincount(null_codes[to_left], minlength=width)
+            values = values[~is_null]
+            if len(values) == 0:
+                continue
+
+            positions = numpy.searchsorted(candidates, values, side='left')
+            histograms += numpy.bincount(positions * width + codes[~is_null],
+                minlength=slots * width).reshape((slots, width))
+            # highest value of each slot, the split values being taken from the data
+            order = numpy.lexsort((values, positions))
+            is_last = numpy.append(positions[order][1:] != positions[order][:-1], True)
+            last_slots = positions[order][is_last]
+            highest_values[last_slots] = numpy.maximum(highest_values[last_slots], values[order][is_last])
+
+        left_hist = numpy.cumsum(histograms, axis=0)[:-1]
+        split_values = numpy.maximum.accumulate(highest_values)[:-1]
+        # thresholds below all the values leave no defined value on the left
+        selected = left_hist.sum(axis=1) > 0
+        if not selected.any():
+            return None, None
+
+        left_hist = left_hist[selected] + null_left
+        total_hist = histograms.sum(axis=0) + null_hist
+        scores = histogram_scores(left_hist, total_hist - left_hist, bins, self.target_entropy())
+        best = numpy.argmin(scores)
+        return float(split_values[selected][best]), float(scores[best])
+
+    def sweep_splits(self, requests):
+        """
+        Scores the splits of several tables, those kept on disk one by one
+        and the others in batches holding no more rows than the memory budget.
+        """
+        results = [(None, None)] * len(requests)
+        batch = list()
+        batch_rows = 0
+        for position, request in enumerate(requests + [None]):
+            if request is not None and request[0].is_on_disk():
+                training_set, dim_key, candidate_values, seed = request
+                results[position] = training_set.sweep_split(dim_key, candidate_values, seed=seed)
+                continue
+
+            if batch and (request is None or batch_rows + request[0].count() > self._memory_rows):
+                scores = super(ChunkedTrainingSet, self).sweep_splits([requests[p] for p in batch])
+                for batch_position, result in zip(batch, scores):
+                    results[batch_position] = result
+
+                batch = list()
+                batch_rows = 0
+
+            if request is not None:
+                batch.append(position)
+                batch_rows += request[0].count()
+
+        return results
+
+    def _sketched_values(self, dim_key):
+        if not self.is_on_disk() or self.count() <= SKETCH_SAMPLE_ROWS:
+            return super(ChunkedTrainingSet, self)._sketched_values(dim_key)
+
+        # sketches of large tables are approximated from a sample of the rows
+        if self._sketch_rows is None:
+            positions = numpy.unique(numpy.random.randint(0, self.count(), size=SKETCH_SAMPLE_ROWS))
+            self._sketch_rows = numpy.asarray(self._rows[positions])
+
+        values = self._columns[dim_key][self._sketch_rows]
+        return values[~numpy.isnan(values)]
+
+    def _measure_range(self, dim_key):
+        if not self.is_on_disk():
+            return super(ChunkedTrainingSet, self)._measure_range(dim_key)
+
+        lowest = None
+        highest = None
+        for values in self._values_chunks(dim_key):
+            if len(values):
+                lowest = float(values.min()) if lowest is None else min(lowest, float(values.min()))
+                highest = float(values.max()) if highest is None else max(highest, float(values.max()))
+
+        return lowest, highest
+
+    def _count_not_null(self, dim_key):
+        if not self.is_on_disk():
+            return super(ChunkedTrainingSet, self)._count_not_null(dim_key)
+
+        return sum(len(values) for values in self._values_chunks(dim_key))
+
+    def _chunks(self):
+        """Row ids of the table, by chunks"""
+        for start in xrange(0, len(self._rows), self._chunk_rows):
+            yield numpy.asarray(self._rows[start:start + self._chunk_rows])
+
+    def _values_chunks(self, dim_key):
+        """Defined values of a dimension over the table, by chunks"""
+        column = self._columns[dim_key]
+        for rows in self._chunks():
+            values = column[rows]
+            yield values[~numpy.isnan(values)]
+
+    def _target_chunks(self):
+        return self._values_chunks(self._output_column)
+
+    def _row_writer(self):
+        return _RowWriter(self._workspace, self._memory_rows, self._row_dtype)
+
+    def _create_child_table(self, rows=None, row_file=None):
+        ts = ChunkedTrainingSet()
+        # inheriting parent data
+        ts._dimensions = self._dimensions
+        ts._output_column = self._output_column
+        ts._output_sampling = self._output_sampling
+        ts._output_min = self._output_min
+        ts._output_max = self._output_max
+        ts._binary_output = self._binary_output
+        ts._index = self._index
+        ts._columns = self._columns
+        ts._target_codes_column = self._target_codes_column
+        ts._sketches = self._sketches
+        ts._memory_rows = self._memory_rows
+        ts._chunk_rows = self._chunk_rows
+        ts._workspace = self._workspace
+        ts._row_dtype = self._row_dtype
+        if rows is None:
+            rows = numpy.arange(0, dtype=self._row_dtype)
+
+        if row_file is None and len(rows) > self._memory_rows:
+            # rows drawn by sample_rows
+            writer = ts._row_writer()
+            writer.append(rows)
+            rows, row_file = writer.close()
+
+        ts._rows = rows
+        ts._row_file = row_file
+        return ts
+
+class _RowWriter(object):
+
+    """
+        Accumulates row ids in memory, moving them to a file as soon as they
+        exceed the memory budget.
+    """
+
+    def __init__(self, workspace, memory_rows, dtype):
+        self.workspace = workspace
+        self.memory_rows = memory_rows
+        self.dtype = dtype
+        self.parts = list()
+        self.size = 0
+        self.output = None
+
+    def append(self, rows):
+        if len(rows) == 0:
+            return
+
+        if self.output is None and self.size + len(rows) > self.memory_rows:
+            self.output = open(self.workspace.new_path('rows'), 'wb')
+            for part in self.parts:
+                part.tofile(self.output)
+
+            self.parts = None
+
+        if self.output is None:
+            self.parts.append(numpy.array(rows, dtype=self.dtype))
+
+        else:
+            numpy.asarray(rows, dtype=self.dtype).tofile(self.output)
+
+        self.size += len(rows)
+
+    def close(self):
+        """
+        @return: tuple (row ids, file holding them or None when kept in memory)
+        """
+        if self.output is None:
+            if not self.parts:
+                return numpy.arange(0, dtype=self.dtype), None
+
+            return numpy.concatenate(self.parts), None
+
+        self.output.close()
+        rows = numpy.memmap(self.output.name, dtype=self.dtype, mode='r', shape=(self.size,))
+        return rows, _TemporaryFile(self.output.name)
+
+class _TemporaryFile(object):
+
+    """Removes a file once no table uses it anymore."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __del__(self, remove=os.remove):
+        try:
+            # mappings of the file stay valid
+            remove(self.path)
+
+        except OSError:
+            pass
+
+class _Workspace(object):
+
+    """Directory of the files of a training set, removed once no table uses it anymore."""
+
+    def __init__(self, directory=None):
+        self.directory = tempfile.mkdtemp(prefix='dtl-chunked-', dir=directory)
+        self._numbers = itertools.count()
+
+    def new_path(self, kind):
+        return os.path.join(self.directory, '%s-%d' % (kind, next(self._numbers)))
+
+    def __del__(self, rmtree=shutil.rmtree):
+        rmtree(self.directory, ignore_errors=True)
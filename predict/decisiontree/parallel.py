@@ -0,0 +1,96 @@
+#
+# -*- coding: utf-8 -*-
+#
+import logging
+_LOG = logging.getLogger('training')
+
+import multiprocessing as mp
+from collections import defaultdict
+
+import numpy
+
+from predict.decisiontree.columnar import ColumnarTrainingSet
+
+# state inherited by the worker processes
+_worker_training_set = None
+_worker_rows = None
+
+def _init_worker(training_set, shared_rows):
+    global _worker_training_set
+    global _worker_rows
+    _worker_training_set = training_set
+    _worker_rows = numpy.frombuffer(shared_rows, dtype=numpy.dtype('l'))
+
+def _sweep_task(batch):
+    """
+    Scores a batch of split requests, tables being given as slices of the
+    shared row indices.
+    """
+    requests = list()
+    for dim_key, offset, count, candidate_values, seed in batch:
+        table = _worker_training_set._create_child_table(_worker_rows[offset:offset + count])
+        requests.append((table, dim_key, candidate_values, seed))
+
+    return _worker_training_set.sweep_splits(requests)
+
+class SplitWorkerPool(object):
+
+    """
+        Spreads the scoring of splits over a pool of processes, one task per
+        dimension. The columns are inherited by the workers when the pool is
+        forked, and the row indices of the tables to be split are passed
+        through shared memory rather than pickled.
+    """
+
+    def __init__(self, training_set, processes):
+        """
+        @param training_set: complete training set, the tables to split being subsets of it
+        @param processes: number of worker processes
+        """
+        assert isinstance(training_set, ColumnarTrainingSet), 'parallel split search requires a columnar training set'
+        self._shared_rows = mp.RawArray('l', max(training_set.count(), 1))
+        self._rows = numpy.frombuffer(self._shared_rows, dtype=numpy.dtype('l'))
+        self._pool = mp.Pool(processes=processes, initializer=_init_worker,
+            initargs=(training_set, self._shared_rows))
+        _LOG.info('split search spread over %d processes' % processes)
+
+    def sweep_splits(self, requests):
+        """
+        Scores the splits as BaseTrainingSet.sweep_splits would do.
+
+        @param requests: list of tuples (table, dimension, candidate values, seed)
+        @return: list of tuples (best value, best score), one per request
+        """
+        # tables of the same tree level do not overlap so that they all fit
+        # in the shared buffer
+        slices = dict()
+        offset = 0
+        for training_set, dim_key, candidate_values, seed in requests:
+            if id(training_set) in slices:
+                continue
+
+            count = training_set.count()
+            self._rows[offset:offset + count] = training_set._rows
+            slices[id(training_set)] = (offset, count)
+            offset += count
+
+        by_dimension = defaultdict(list)
+        for position, (training_set, dim_key, candidate_values, seed) in enumerate(requests):
+            offset, count = slices[id(training_set)]
+            by_dimension[dim_key].append((position, (dim_key, offset, count, candidate_values, seed)))
+
+        pending = list()
+        for dim_key, tasks in by_dimension.items():
+            batch = [task for position, task in tasks]
+            pending.append(([position for position, task in tasks], self._pool.apply_async(_sweep_task, (batch,))))
+
+        results = [(None, None)] * len(requests)
+        for positions, status in pending:
+            for position, result in zip(positions, status.get()):
+                results[position] = result
+
+        return results
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,103 @@
+#
+# -*- coding: utf-8 -*-
+#
+import time
+import logging
+import threading
+from Queue import Queue
+from Queue import Empty
+
+import numpy
+
+_LOG = logging.getLogger('training')
+
+class MicroBatcher(object):
+
+    """
+        Groups the prediction requests of concurrent callers into batches
+        scored at once by a compiled forest. A batch is closed when no more
+        request arrives within max_delay of the first one, or when it holds
+        max_rows samples.
+    """
+
+    def __init__(self, compiled_forest, max_delay=0.005, max_rows=10000):
+        """
+        @param compiled_forest: forest scoring the batches, see compiled.CompiledForest
+        @param max_delay: time in seconds a request may wait for other requests to join its batch
+        @param max_rows: maximum number of samples per batch
+        """
+        self.compiled_forest = compiled_forest
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self._requests = Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, samples, use_median=False):
+        """
+        Predicts samples given as dictionaries, blocking until the batch
+        holding them is scored. Samples are converted in the calling thread,
+        so that invalid values only fail their own request.
+
+        @return: list of predictions, None for the samples no tree was able to predict
+        """
+        request = _Request(self.compiled_forest.matrix(samples), use_median)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return request.predictions
+
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            rows_count = len(batch[0].matrix)
+            deadline = time.time() + self.max_delay
+            while rows_count < self.max_rows:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    request = self._requests.get(timeout=timeout)
+
+                except Empty:
+                    break
+
+                batch.append(request)
+                rows_count += len(request.matrix)
+
+            _LOG.debug('scoring %d requests for a total of %d samples' % (len(batch), rows_count))
+            for use_median in (False, True):
+                requests = [request for request in batch if request.use_median == use_median]
+                if requests:
+                    self._score(requests, use_median)
+
+    def _score(self, requests, use_median):
+        try:
+            matrix = numpy.concatenate([request.matrix for request in requests])
+            values = self.compiled_forest.predict_batch(matrix, use_median=use_median)
+            predictions = [None if value != value else value for value in values.tolist()]
+            start = 0
+            for request in requests:
+                request.predictions = predictions[start:start + len(request.matrix)]
+                start += len(request.matrix)
+
+        except Exception, e:
+            _LOG.exception('failed scoring a batch of %d requests' % len(requests))
+            for request in requests:
+                request.error = e
+
+        for request in requests:
+            request.done.set()
+
+class _Request(object):
+
+    def __init__(self, matrix, use_median):
+        self.matrix = matrix
+        self.use_median = use_median
+        self.predictions = None
+        self.error = None
+        self.done = threading.Event()
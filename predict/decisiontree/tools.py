@@ -1,4 +1,5 @@
 import math
+import random
 import logging
 _LOG = logging.getLogger('tools')
 
@@ -9,6 +10,17 @@ def elog(x):
     if x == 0.0: return 0.0
     return x * math.log(x)
 
+def random_sides(count, seed=None):
+    """
+    Random assignment of count items to the left (True) or right (False),
+    drawn at once and reproducible from seed.
+    """
+    if count == 0:
+        return []
+        
+    bits = random.Random(seed).getrandbits(count)
+    return [bit == '1' for bit in format(bits, '0%db' % count)]
+
 def histogram(x, bins, min_x=None, max_x=None):
     """
     Histogram if the input data in the form of an ordered list of bins.
@@ -29,6 +41,40 @@ def histogram(x, bins, min_x=None, max_x=None):
         
     return h
 
+def bin_index(x_i, bins, min_x, max_x):
+    """
+    Index of the bin holding x_i, consistent with histogram().
+    """
+    if min_x == max_x:
+        return 0
+        
+    alpha = float(x_i - min_x) / float(max_x - min_x)
+    return int(float(bins - 1) * alpha)
+
+def counts_entropy(counts):
+    """
+    Entropy of a histogram given as a list of bin counts.
+    """
+    total = sum(counts)
+    if total == 0:
+        return 0.0
+        
+    e = 0.0
+    for count in counts:
+        e += elog(float(count) / total)
+    
+    return -e
+
+def codes_entropy(codes, bins):
+    """
+    Entropy of a list of bin indices, as returned by bin_index().
+    """
+    counts = [0] * bins
+    for code in codes:
+        counts[code] += 1
+        
+    return counts_entropy(counts)
+
 def binary_entropy(x):
     x0 = x[0]
     count = 0
@@ -61,6 +107,38 @@ def entropy(x, min_x=None, max_x=None, accuracy=20):
     
     return -e
 
+def quantile_sketch(sorted_values, size):
+    """
+    Distinct values found at evenly spaced ranks of a sorted list, at most
+    size of them, always including the extreme values.
+    """
+    count = len(sorted_values)
+    if count == 0:
+        return []
+        
+    if count <= size:
+        ranks = xrange(count)
+        
+    else:
+        ranks = [int(round(float(k) * (count - 1) / (size - 1))) for k in xrange(size)]
+        
+    sketch = list()
+    for rank in ranks:
+        value = sorted_values[rank]
+        if not sketch or value != sketch[-1]:
+            sketch.append(value)
+            
+    return sketch
+
+def spread(values, size):
+    """
+    At most size elements of a list picked at evenly spaced positions.
+    """
+    if len(values) <= size:
+        return values
+        
+    return [values[int(k * len(values) / size)] for k in xrange(size)]
+    
 def median(values):
     median = None
     if len(values) & 1:
@@ -73,8 +151,40 @@ def median(values):
     
     return median
     
+def normal_quantile(p):
+    """
+    Quantile of the standard normal distribution, found by bisection on the
+    cumulative distribution function.
+    """
+    assert 0.0 < p < 1.0, 'probability must be within ]0, 1['
+    low, high = -40.0, 40.0
+    for i in xrange(100):
+        middle = 0.5 * (low + high)
+        if 0.5 * (1.0 + math.erf(middle / math.sqrt(2.0))) < p:
+            low = middle
+            
+        else:
+            high = middle
+            
+    return 0.5 * (low + high)
+    
+def mean_interval(count, total, total_squares, z):
+    """
+    Half-width of the confidence interval of a mean, from running sums.
+    
+    @param count: number of values
+    @param total: sum of the values
+    @param total_squares: sum of the squared values
+    @param z: normal quantile of the confidence level, see normal_quantile
+    @return: half-width, None for less than two values
+    """
+    if count < 2:
+        return None
+        
+    variance = max(total_squares - total * total / count, 0.0) / (count - 1)
+    return z * math.sqrt(variance / count)
+    
 if __name__ == '__main__':
-    import random
     import sys
     ones = [1, 0, 1, 1, 1, 1, 1, 0, 1, 1]
     zeros = [0, 0, 1, 0, 0, 0, 0, 0, 0, 0]
@@ -5,7 +5,10 @@ import logging
 _LOG = logging.getLogger('training')
 
 import random
+import bisect
+from itertools import islice
 from collections import defaultdict
+from operator import itemgetter
 
 from predict.decisiontree import tools
 
@@ -23,45 +26,149 @@ def as_int(s):
     except ValueError:
         return None
        
+def as_number(s):
+    """Integer, or float when not an integer, None when not a number"""
+    value = as_int(s)
+    if value is None:
+        value = as_float(s)
+        
+    return value
+    
+# rows read and parsed at once by train_csv
+LOAD_BLOCK_SIZE = 10000
+# rows of the first block used for inferring the type of each column
+TYPE_SAMPLE_SIZE = 1000
+
+def parse_ints(cells):
+    return [int(cell) if cell else None for cell in cells]
+    
+def parse_floats(cells):
+    return [float(cell) if cell else None for cell in cells]
+    
+def parse_numbers(cells):
+    return [as_number(cell) for cell in cells]
+    
+def infer_parser(cells):
+    """
+    Chooses the function parsing a column from a sample of its cells: cells
+    are parsed as integers, or floats, when all the non-empty sampled cells
+    are, and one by one otherwise.
+    """
+    values = [as_number(cell) for cell in cells if cell]
+    if any(value is None for value in values):
+        return parse_numbers
+        
+    if all(isinstance(value, (int, long)) for value in values):
+        return parse_ints
+        
+    return parse_floats
+    
+def parse_column(cells, parser):
+    """
+    Parses a block of cells at once, falling back to parsing the cells one
+    by one when some cell does not match the type inferred for the column.
+    """
+    try:
+        return parser(cells)
+        
+    except ValueError:
+        return parse_numbers(cells)
+        
 class TrainingSetFactory(object):
 
-    def train_csv(self, input_file, target_name='target', output_sampling=5, ignore_columns=None, use_columns=None):
+    def train_csv(self, input_file, target_name='target', output_sampling=5, ignore_columns=None, use_columns=None,
+            columnar=False, binned=False, sketch_size=256, cache=None, memory_budget=None, workspace_dir=None):
+        """
+        @param columnar: loads the data into numpy columns instead of lists of rows
+        @param binned: quantizes each dimension into at most 255 bins at load time
+        @param sketch_size: number of quantiles kept per dimension for generating split candidates
+        @param cache: maps the columns parsed by a previous run when found, see cache.DatasetCache,
+            requires columnar or binned, training sets kept on disk are never cached
+        @param memory_budget: size in bytes above which the rows of a table are kept on disk,
+            see outofcore.ChunkedTrainingSet, None for loading the data in memory, cannot be binned
+        @param workspace_dir: directory of the working files of a training set kept on disk,
+            the system temporary directory by default
+        """
         import csv
         _LOG.info('loading training set')
         if ignore_columns is None:
             ignore_columns = list()
             
-        ts = TrainingSet()
+        if cache is not None and memory_budget is not None:
+            raise ValueError('training sets kept on disk cannot be cached, their columns only live in a temporary workspace')
+            
+        if binned and memory_budget is not None:
+            raise ValueError('training sets kept on disk cannot be binned')
+            
+        if cache is not None:
+            if not (columnar or binned):
+                _LOG.warn('only columnar and binned training sets are cached')
+                cache = None
+                
+            else:
+                key = cache.key(input_file, target_name=target_name, output_sampling=output_sampling,
+                    ignore_columns=sorted(ignore_columns), use_columns=use_columns and sorted(use_columns),
+                    binned=binned, sketch_size=sketch_size)
+                ts = cache.load(key)
+                if ts is not None:
+                    return ts
+                    
+        if memory_budget is not None:
+            from predict.decisiontree.outofcore import ChunkedTrainingSet
+            ts = ChunkedTrainingSet(memory_budget, directory=workspace_dir)
+            
+        elif binned:
+            from predict.decisiontree.binned import BinnedTrainingSet
+            ts = BinnedTrainingSet()
+            
+        elif columnar:
+            from predict.decisiontree.columnar import ColumnarTrainingSet
+            ts = ColumnarTrainingSet()
+            
+        else:
+            ts = TrainingSet()
+            
         input_data = csv.reader(input_file, delimiter=',')
         first_row = next(input_data)[1:]
         header = [label for label in first_row
             if label not in ignore_columns and (use_columns is None or label in use_columns or label == target_name)]
-        header_index = set([index for index, label in enumerate(first_row) 
-            if label not in ignore_columns and (use_columns is None or label in use_columns or label == target_name)])
+        # positions of the kept columns in the csv rows, the first column holding the row ids
+        positions = [index + 1 for index, label in enumerate(first_row) 
+            if label not in ignore_columns and (use_columns is None or label in use_columns or label == target_name)]
         assert target_name in header, 'target column "%s" is missing in input dataset' % target_name
-        target_index = first_row.index(target_name)
+        target_index = header.index(target_name)
         ts.set_dimensions(header)
         output_categories = set()
-        for columns in input_data:
-            row = list()
-            for index, cell in enumerate(columns[1:]):
-                if index not in header_index: continue
-                value = as_int(cell)
-                if not value:
-                    value = as_float(cell)
+        parsers = None
+        width = len(first_row) + 1
+        for block in iter(lambda: list(islice(input_data, LOAD_BLOCK_SIZE)), []):
+            # short rows are completed with undefined values, blank lines skipped
+            block = [row if len(row) == width else (row + [''] * width)[:width] for row in block if row]
+            if not block:
+                continue
                 
-                if len(output_categories) < 3:
-                    if index == target_index:
-                        output_categories.add(value)
-                    
-                row.append(value)
-
-            ts.insert(row)
+            # columns left out are transposed but never parsed
+            cells = zip(*block)
+            if parsers is None:
+                parsers = [infer_parser(cells[position][:TYPE_SAMPLE_SIZE]) for position in positions]
+                _LOG.debug('column parsers: %s' % ', '.join('%s=%s' % (label, parser.__name__)
+                    for label, parser in zip(header, parsers)))
+                
+            columns = [parse_column(cells[position], parser) for position, parser in zip(positions, parsers)]
+            if len(output_categories) < 3:
+                output_categories.update(columns[target_index])
+                
+            ts.insert_columns(columns)
 
         is_binary_output = len(output_categories) == 2
         ts.set_binary_output(is_binary_output)
         ts.setup_output(target_name, output_sampling=output_sampling)
+        ts.build_sketches(sketch_size)
+        ts.index_not_null()
         _LOG.info('training set: %d samples and %d dimensions loaded' % (ts.count(), len(header)))
+        if cache is not None:
+            ts = cache.store(key, ts)
+            
         return ts
 
     def train_x_y(self, func, count, range_x, range_y,
@@ -112,6 +219,13 @@ class BaseTrainingSet(object):
         self._output_max = None
         self._output_sampling = None
         self._output_column = None
+        # quantiles of each dimension over the full set
+        self._sketches = dict()
+        # number of defined values per dimension
+        self._not_null_counts = dict()
+        # ratios of the dimensions defined for all the rows or for none of them
+        # in a parent table, which holds for its child tables too
+        self._uniform_ratios = dict()
 
     def set_binary_output(self, is_binary_output):
         if is_binary_output:
@@ -122,18 +236,210 @@ class BaseTrainingSet(object):
     def insert(self, item):
         self._items.append(item)
 
+    def insert_columns(self, columns):
+        """
+        Appends a block of rows given as one list of values per dimension.
+        """
+        for row in zip(*columns):
+            self.insert(list(row))
+
     def count(self):
         """Counts the number of rows in the table."""
         return len(self._get_items())
 
-    def random_split(self, set_left, set_right):
-        for item in self._get_items():
-            random.choice([set_left, set_right]).insert(item)
+    def random_split(self, set_left, set_right, seed=None):
+        """
+        Randomly dispatches the rows between two tables.
+
+        @param seed: seed making the assignment reproducible, see tools.random_sides
+        """
+        items = self._get_items()
+        for item, to_left in zip(items, tools.random_sides(len(items), seed)):
+            if to_left:
+                set_left.insert(item)
+                
+            else:
+                set_right.insert(item)
 
     def get_dimensions(self):
         """Gets all defined dimensions"""
         return self._dimensions
 
+    def build_sketches(self, size):
+        """
+        Summarizes each input dimension by a list of distinct quantiles,
+        shared by all the tables derived from this one.
+
+        @param size: maximum number of quantiles per dimension
+        """
+        for dim in self.get_dimensions():
+            if dim != self._output_column:
+                self._sketches[dim] = tools.quantile_sketch(self._get_list_not_null(dim), size)
+                # the sorted values are not needed anymore for the complete set
+                del self._list_not_null[dim]
+
+    def index_not_null(self):
+        """
+        Counts once the defined values of each input dimension.
+        """
+        for dim in self.get_dimensions():
+            if dim != self._output_column:
+                _LOG.debug('dimension %s: %.1f%% of values defined' % (dim, 100.0 * self.not_null_ratio(dim)))
+
+    def not_null_ratio(self, dim_key):
+        """
+        Ratio of rows where a dimension is defined.
+
+        @param dim_key: the dimension
+        @return: ratio between 0 and 1, 0 for an empty table
+        """
+        count = self.count()
+        if count == 0:
+            return 0.0
+
+        if dim_key not in self._not_null_counts:
+            if dim_key in self._uniform_ratios:
+                return self._uniform_ratios[dim_key]
+
+            self._not_null_counts[dim_key] = self._count_not_null(dim_key)
+
+        return float(self._not_null_counts[dim_key]) / count
+
+    def _count_not_null(self, dim_key):
+        return sum(1 for item in self._get_items() if self._get_measure(item, dim_key) is not None)
+
+    def _set_split_counts(self, dim_key, left_table, right_table, null_table):
+        """
+        Counts of defined values along the split dimension are known for the
+        child tables, the undefined rows later dispatched by random_split
+        leaving them unchanged.
+        """
+        left_table._not_null_counts[dim_key] = left_table.count()
+        right_table._not_null_counts[dim_key] = right_table.count()
+        null_table._not_null_counts[dim_key] = 0
+        self._set_uniform_ratios(left_table, right_table, null_table)
+
+    def _set_uniform_ratios(self, *tables):
+        """
+        Dimensions counted as defined for all the rows of this table or for
+        none of them are not counted again in tables of some of its rows.
+        """
+        count = self.count()
+        uniform_ratios = dict(self._uniform_ratios)
+        for dim, not_null_count in self._not_null_counts.iteritems():
+            if count > 0 and (not_null_count == 0 or not_null_count == count):
+                uniform_ratios[dim] = float(not_null_count) / count
+
+        for table in tables:
+            table._uniform_ratios = uniform_ratios
+
+    def candidate_values(self, dim_key, size):
+        """
+        Deduplicated split candidates along a dimension, taken from the
+        quantiles of the full set falling within the range of values of this
+        table, possibly fewer than size. Falls back to values sampled from the
+        table when no quantile falls within that range.
+
+        @param dim_key: the dimension
+        @param size: maximum number of candidates
+        @return: set of values, possibly empty
+        """
+        sketch = self._sketches.get(dim_key)
+        if sketch is not None:
+            lowest, highest = self._measure_range(dim_key)
+            if lowest is None:
+                return set()
+
+            within = sketch[bisect.bisect_left(sketch, lowest):bisect.bisect_left(sketch, highest)]
+            if len(within) > size:
+                return set(tools.spread(within, size))
+
+            if len(within) > 0:
+                return set(within)
+
+        return set([value for value in self.sample_measures(dim_key, size)
+            if value is not None])
+
+    def _measure_range(self, dim_key):
+        """
+        Lowest and highest values of a dimension within the table, (None, None) when undefined.
+        """
+        measures = [measure for measure in (self._get_measure(item, dim_key) for item in self._get_items())
+            if measure is not None]
+        if len(measures) == 0:
+            return None, None
+
+        return min(measures), max(measures)
+
+    def sample_rows(self, size, replace=False):
+        """
+        Draws rows at random, with replacement when bootstrapping. The drawn
+        rows are referenced by the resulting table, never copied.
+
+        @param size: number of rows to draw
+        @param replace: draws with replacement
+        @return: tuple (table of the drawn rows, positions of the rows never drawn)
+        """
+        items = self._get_items()
+        count = len(items)
+        if replace:
+            positions = [random.randrange(count) for index in xrange(size)]
+
+        else:
+            positions = random.sample(xrange(count), size)
+
+        table = self._create_child_table()
+        for position in positions:
+            table.insert(items[position])
+
+        self._set_uniform_ratios(table)
+        drawn = set(positions)
+        out_of_bag = [position for position in xrange(count) if position not in drawn]
+        return table, out_of_bag
+
+    def get_sample(self, position):
+        """
+        Input values of a row, as expected by the prediction.
+
+        @param position: position of the row in the table
+        """
+        item = self._get_items()[position]
+        sample = dict()
+        for dim in self.get_dimensions():
+            if dim == self._output_column:
+                continue
+
+            measure = self._get_measure(item, dim)
+            if measure is not None:
+                sample[dim] = measure
+
+        return sample
+
+    def get_rows(self, positions, dimensions):
+        """
+        Input values of several rows, as expected by the positional
+        prediction, see BaseDecisionNode.predict_row
+
+        @param positions: positions of the rows in the table
+        @param dimensions: dimensions of the values of each row, None for values left undefined
+        @return: list of rows, None for undefined values
+        """
+        items = self._get_items()
+        rows = list()
+        for position in positions:
+            item = items[position]
+            rows.append([None if dim is None else self._get_measure(item, dim) for dim in dimensions])
+
+        return rows
+
+    def get_target(self, position):
+        """
+        Output value of a row.
+
+        @param position: position of the row in the table
+        """
+        return self._get_target(self._get_items()[position])
+
     def target_median(self):
         """
         Computes the median of the output
@@ -152,22 +458,15 @@ class BaseTrainingSet(object):
 
     def target_entropy(self):
         """
-        Computes the statistics (median, entropy) for a dimension
+        Computes the entropy of the output from its binned values
         """
-        if not self._entropy:
-            values = self._get_list_not_null(self._output_column)
-            if len(values) == 0:
+        if self._entropy is None:
+            codes = [code for code in self._get_target_codes() if code is not None]
+            if len(codes) == 0:
                 entropy = None
 
             else:
-                if self._binary_output:
-                    entropy = tools.binary_entropy(values)
-                    
-                else:
-                    entropy = tools.entropy(values,
-                            self._output_min,
-                            self._output_max,
-                            accuracy=self._output_sampling)
+                entropy = tools.codes_entropy(codes, self.target_bins())
                 
             self._entropy = entropy
             
@@ -196,8 +495,154 @@ class BaseTrainingSet(object):
             else:
                 right_table.insert(item)
 
+        self._set_split_counts(dim_key, left_table, right_table, null_table)
         return left_table, right_table, null_table
 
+    def target_bins(self):
+        """
+        Number of bins used for sampling the output, at least two for binary
+        outputs so that both values keep their own bin
+        """
+        if self._binary_output:
+            return max(self._output_sampling, 2)
+
+        return self._output_sampling
+
+    def sorted_measures(self, dim_key):
+        """
+        Non null values of a dimension in increasing order, along with the
+        binned output of the corresponding rows. The binned output of rows
+        where the dimension is undefined is returned separately.
+        Rows with an undefined output are given a None bin.
+
+        @param dim_key: dimension to sort on
+
+        """
+        pairs = list()
+        null_codes = list()
+        for item in self._get_items():
+            measure = self._get_measure(item, dim_key)
+            code = self._get_target_code(item)
+            if measure is None:
+                null_codes.append(code)
+
+            else:
+                pairs.append((measure, code))
+
+        pairs.sort(key=itemgetter(0))
+        measures = [measure for measure, code in pairs]
+        codes = [code for measure, code in pairs]
+        return measures, codes, null_codes
+
+    def sweep_split(self, dim_key, candidate_values=None, seed=None):
+        """
+        Scores the splits along a dimension in a single pass over the rows sorted
+        by value, moving rows from the right histogram of the output to the left
+        one. Rows where the dimension is undefined are randomly assigned to either
+        side once for all the thresholds, as random_split would do for the same seed.
+
+        A candidate threshold is scored as the highest value of the table not
+        above it, which partitions the table the same way.
+
+        @param dim_key: dimension to split on
+        @param candidate_values: set of thresholds to be scored, all distinct values when None
+        @param seed: seed for assigning the rows where the dimension is undefined
+        @return: tuple (best value, best score)
+        """
+        measures, codes, null_codes = self.sorted_measures(dim_key)
+        bins = self.target_bins()
+        left_hist = [0] * bins
+        right_hist = [0] * bins
+        left_count = 0
+        right_count = len(measures)
+        for code in codes:
+            if code is not None:
+                right_hist[code] += 1
+
+        for code, to_left in zip(null_codes, tools.random_sides(len(null_codes), seed)):
+            if to_left:
+                left_count += 1
+                if code is not None:
+                    left_hist[code] += 1
+
+            else:
+                right_count += 1
+                if code is not None:
+                    right_hist[code] += 1
+
+        total = left_count + right_count
+        node_entropy = self.target_entropy()
+        best_value = None
+        best_score = None
+        last = len(measures) - 1
+        candidates = None
+        if candidate_values is not None:
+            candidates = sorted(candidate_values)
+            candidate = 0
+
+        for position, measure in enumerate(measures):
+            code = codes[position]
+            left_count += 1
+            right_count -= 1
+            if code is not None:
+                left_hist[code] += 1
+                right_hist[code] -= 1
+
+            if position < last and measures[position + 1] == measure:
+                # not a boundary between distinct values
+                continue
+
+            if candidates is not None:
+                # skipping unless a candidate falls between this value and the next one
+                while candidate < len(candidates) and candidates[candidate] < measure:
+                    candidate += 1
+
+                if candidate == len(candidates):
+                    break
+
+                if position < last and candidates[candidate] >= measures[position + 1]:
+                    continue
+
+            if left_count == 0 or right_count == 0:
+                score = node_entropy
+
+            else:
+                alpha = float(left_count) / total
+                score = alpha * tools.counts_entropy(left_hist) + (1.0 - alpha) * tools.counts_entropy(right_hist)
+
+            if best_score is None or score < best_score:
+                best_score = score
+                best_value = measure
+
+        return best_value, best_score
+
+    def sweep_splits(self, requests):
+        """
+        Scores the splits of several tables sharing the data of this table,
+        as sweep_split would do for each of them.
+
+        @param requests: list of tuples (table, dimension, candidate values, seed)
+        @return: list of tuples (best value, best score), one per request
+        """
+        return [training_set.sweep_split(dim_key, candidate_values, seed=seed)
+            for training_set, dim_key, candidate_values, seed in requests]
+
+    def _target_code(self, value):
+        if value is None:
+            return None
+
+        return tools.bin_index(value, self.target_bins(),
+            self._output_min, self._output_max)
+
+    def _get_target(self, item):
+        return self._get_measure(item, self._output_column)
+
+    def _get_target_code(self, item):
+        return self._target_code(self._get_target(item))
+
+    def _get_target_codes(self):
+        return [self._get_target_code(item) for item in self._get_items()]
+
     def _get_items(self):
         return self._items
 
@@ -213,6 +658,7 @@ class TrainingSet(BaseTrainingSet):
     def __init__(self):
         super(TrainingSet, self).__init__()
         self._index = dict()
+        self._code_index = None
 
     def check_column(self, column_name):
         return column_name in self.get_dimensions()
@@ -239,6 +685,8 @@ class TrainingSet(BaseTrainingSet):
         ts._output_max = self._output_max
         ts._binary_output = self._binary_output
         ts._index = self._index
+        ts._code_index = self._code_index
+        ts._sketches = self._sketches
         return ts
         
     def setup_output(self, output_column_name, output_sampling):
@@ -248,12 +696,17 @@ class TrainingSet(BaseTrainingSet):
         
         def items():
             for item in self._get_items():
-                yield item[output_index]
+                if item[output_index] is not None:
+                    yield item[output_index]
                 
         self._output_min = min(items())
         self._output_max = max(items())
         _LOG.info('output min = %s' % self._output_min)
         _LOG.info('output max = %s' % self._output_max)
+        # binned output is computed once and kept at the end of each row
+        self._code_index = len(self._dimensions)
+        for item in self._get_items():
+            item.append(self._target_code(item[output_index]))
         
     def sample_measures(self, dim_key, sample_size):
         """
@@ -264,12 +717,17 @@ class TrainingSet(BaseTrainingSet):
 
         """
         index = self._index[dim_key]
-        sample_size = min(sample_size, self.count())
-        return [item[index] for item in random.sample(self._get_items(), sample_size)]
+        items = self._get_items()
+        sample_size = min(sample_size, len(items))
+        # sampling positions rather than the items, which would copy them all
+        return [items[position][index] for position in random.sample(xrange(len(items)), sample_size)]
 
     def _get_measure(self, item, dim_key):
         index = self._index[dim_key]
         return item[index]
+
+    def _get_target_code(self, item):
+        return item[self._code_index]
         
     def set_dimensions(self, dimensions):
         self._dimensions = dimensions
@@ -0,0 +1,61 @@
+#
+# -*- coding: utf-8 -*-
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+from predict.decisiontree import DecisionNode
+from predict.decisiontree import LeafDecisionNode
+from predict.decisiontree import codegen
+from predict.decisiontree.forest import load_forest
+from predict.decisiontree.forest import write_trees
+
+def write_shard(path, split_value):
+    with open(path, 'wb') as output:
+        write_trees([DecisionNode(split_value, 'a', LeafDecisionNode(1.0), LeafDecisionNode(2.0))], output)
+
+class GeneratedModuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='dtl-test-')
+        self.forest_path = os.path.join(self.directory, 'forest')
+        self.cache_directory = os.path.join(self.directory, 'modules')
+        os.mkdir(self.forest_path)
+        write_shard(os.path.join(self.forest_path, 's1'), 0.5)
+        write_shard(os.path.join(self.forest_path, 's2'), 1.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_module_of_shard_kept_out_of_forest_directory(self):
+        shard_path = os.path.join(self.forest_path, 's1')
+        path = codegen.module_path(shard_path, self.cache_directory)
+        codegen.write_module(load_forest(shard_path).trees, path)
+        self.assertEqual(sorted(os.listdir(self.forest_path)), ['s1', 's2'])
+
+        forest = load_forest(self.forest_path)
+        self.assertEqual(len(forest.trees), 2)
+        generated = codegen.GeneratedForest(codegen.load_module(path))
+        self.assertEqual(generated.predict({'a': 1.0}), 2.0)
+
+    def test_forest_directory_skips_modules_generated_next_to_shards(self):
+        shard_path = os.path.join(self.forest_path, 's1')
+        codegen.write_module(load_forest(shard_path).trees, shard_path + '.py')
+        forest = load_forest(self.forest_path)
+        self.assertEqual(len(forest.trees), 2)
+
+    def test_infinite_values_emitted(self):
+        path = os.path.join(self.directory, 'infinite.py')
+        codegen.write_module([DecisionNode(float('inf'), 'a', LeafDecisionNode(float('-inf')), LeafDecisionNode(2.0))],
+            path)
+        generated = codegen.GeneratedForest(codegen.load_module(path))
+        self.assertEqual(generated.predict({'a': 1.0}), float('-inf'))
+
+    def test_module_paths_of_shards_differ(self):
+        self.assertNotEqual(codegen.module_path(os.path.join(self.forest_path, 's1'), self.cache_directory),
+            codegen.module_path(os.path.join(self.directory, 's1'), self.cache_directory))
+
+if __name__ == '__main__':
+    unittest.main()
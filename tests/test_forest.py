@@ -0,0 +1,40 @@
+#
+# -*- coding: utf-8 -*-
+#
+import unittest
+
+from predict.decisiontree import DecisionNode
+from predict.decisiontree import LeafDecisionNode
+from predict.decisiontree.forest import RandomForest
+
+def stump(dimension):
+    return DecisionNode(0.0, dimension, LeafDecisionNode(10.0), LeafDecisionNode(11.0))
+
+def forest(trees):
+    forest = RandomForest()
+    forest.use_trees(trees)
+    return forest
+
+class SharedTreesTest(unittest.TestCase):
+
+    def test_tree_indexed_by_another_forest(self):
+        tree = stump('a')
+        first = forest([tree])
+        self.assertEqual(first.predict({'a': 1.0}), 11.0)
+
+        second = forest([stump('b'), tree])
+        self.assertEqual(sorted(dim for dim in second.dimensions if dim is not None), ['a', 'b'])
+        self.assertEqual(second.predict({'a': -1.0, 'b': 5.0}), 10.5)
+        # the first forest is left unchanged
+        self.assertEqual(first.predict({'a': 1.0, 'b': -5.0}), 11.0)
+
+    def test_rows_follow_dimensions(self):
+        tree = stump('c')
+        first = forest([stump('d'), tree])
+        second = forest([tree])
+        for trees in (first, second):
+            row = trees.row({'c': 1.0, 'd': -1.0})
+            self.assertEqual(trees.predict(row), trees.predict({'c': 1.0, 'd': -1.0}))
+
+if __name__ == '__main__':
+    unittest.main()
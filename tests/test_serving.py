@@ -0,0 +1,59 @@
+#
+# -*- coding: utf-8 -*-
+#
+import threading
+import unittest
+
+import numpy
+
+from predict.decisiontree.compiled import CompiledForest
+from predict.decisiontree.compiled import LEAF
+from predict.decisiontree.serving import MicroBatcher
+
+def single_split_forest():
+    """Forest of one tree predicting 1.0 when a <= 0.5, 2.0 otherwise."""
+    return CompiledForest(['a'], [0], [0, LEAF, LEAF], [0.5, numpy.nan, numpy.nan], [1, 0, 0], [2, 0, 0],
+        [numpy.nan, 1.0, 2.0])
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def test_invalid_sample_only_fails_its_request(self):
+        # long enough for both requests to join the same batch
+        batcher = MicroBatcher(single_split_forest(), max_delay=0.2)
+        results = dict()
+
+        def predict(name, samples):
+            try:
+                results[name] = batcher.predict(samples)
+
+            except Exception, e:
+                results[name] = e
+
+        threads = [
+            threading.Thread(target=predict, args=('valid', [{'a': 1.0}, {'a': 0.0}])),
+            threading.Thread(target=predict, args=('invalid', [{'a': 'oops'}]))
+        ]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results['valid'], [2.0, 1.0])
+        self.assertTrue(isinstance(results['invalid'], ValueError))
+
+    def test_requests_batched_together(self):
+        batcher = MicroBatcher(single_split_forest(), max_delay=0.2)
+        results = dict()
+        threads = [threading.Thread(target=lambda n=n: results.__setitem__(n, batcher.predict([{'a': n}])))
+            for n in (0.0, 1.0, None)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {0.0: [1.0], 1.0: [2.0], None: [1.5]})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#
+# -*- coding: utf-8 -*-
+#
+import math
+import unittest
+from StringIO import StringIO
+
+from predict.decisiontree.train import TrainingSetFactory
+
+def binary_csv(rows_count=40):
+    lines = ['id,a,target']
+    for row in xrange(rows_count):
+        lines.append('%d,%d,%d' % (row, row, row % 2))
+
+    return StringIO('\n'.join(lines) + '\n')
+
+def sparse_csv(rows_count=40):
+    lines = ['id,a,b,c,target']
+    for row in xrange(rows_count):
+        lines.append('%d,%d,,%s,%d' % (row, row, row if row % 3 else '', row % 2))
+
+    return StringIO('\n'.join(lines) + '\n')
+
+class BinaryOutputTest(unittest.TestCase):
+
+    def assert_binary_entropy(self, **options):
+        ts = TrainingSetFactory().train_csv(binary_csv(), output_sampling=1, **options)
+        self.assertEqual(ts.target_bins(), 2)
+        # both values are equally frequent
+        self.assertAlmostEqual(ts.target_entropy(), math.log(2.0))
+
+    def test_single_output_bin_keeps_binary_values_apart(self):
+        self.assert_binary_entropy()
+
+    def test_columnar(self):
+        self.assert_binary_entropy(columnar=True)
+
+    def test_binned(self):
+        self.assert_binary_entropy(binned=True)
+
+    def test_kept_on_disk(self):
+        self.assert_binary_entropy(memory_budget=1)
+
+class NotNullRatioTest(unittest.TestCase):
+
+    def assert_uniform_ratios_inherited(self, **options):
+        ts = TrainingSetFactory().train_csv(sparse_csv(), **options)
+        left, right, null = ts.split('a', 10)
+        null.random_split(left, right)
+        for table in (left, right):
+            # only the dimension defined for some of the rows is counted again
+            counted = list()
+            count_not_null = table._count_not_null
+            table._count_not_null = lambda dim_key: counted.append(dim_key) or count_not_null(dim_key)
+            self.assertEqual(table.not_null_ratio('a'), 1.0)
+            self.assertEqual(table.not_null_ratio('b'), 0.0)
+            self.assertTrue(0.0 < table.not_null_ratio('c') < 1.0)
+            self.assertEqual(counted, ['c'])
+
+    def test_list(self):
+        self.assert_uniform_ratios_inherited()
+
+    def test_columnar(self):
+        self.assert_uniform_ratios_inherited(columnar=True)
+
+if __name__ == '__main__':
+    unittest.main()